@@ -1,9 +1,16 @@
+import functools
+import hashlib
+import hmac
 import os
-from flask import Flask, render_template, redirect, request, flash, session
-from models import db, connect_db, User, Project, Collaboration, ProjectStack, UserPreferenceSector, UserPreferenceStack, Sector, Stack
+from flask import Flask, render_template, redirect, request, flash, session, jsonify, g
+from models import db, connect_db, User, Project, Collaboration, ProjectStack, UserPreferenceSector, UserPreferenceStack, UserProjectMatch, Sector, Stack
 from forms import RegisterUserForm, LoginUserForm, AddProjectForm, SectorPreferenceForm, StackPreferenceForm, PreferenceForm, UserProfileForm, PreferenceFormOwnProject
-from git import get_stacks, get_collaborators, validate_git_handle_ownership, validate_repo_existence
-from schedule import start_scheduler, connect_scheduler
+from git import validate_git_handle_ownership, validate_repo_existence, github, RateLimitExceeded
+import metrics
+from reference import reference_data
+from schedule import start_scheduler, connect_scheduler, enqueue_project_sync
+from sqlalchemy import func
+from sqlalchemy.orm import joinedload, selectinload
 
 app = Flask(__name__)
 app.config['SECRET_KEY'] = os.environ.get('SECRET_KEY', '<fsa64ghfa78hjfa>')
@@ -11,27 +18,56 @@ app.config['SQLALCHEMY_DATABASE_URI'] = os.environ.get(
     'DATABASE_URL', 'postgres:///colab').replace("://", "ql://", 1)
 app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
 app.config['SQLALCHEMY_ECHO'] = True
+app.config['GITHUB_WEBHOOK_SECRET'] = os.environ.get('GITHUB_WEBHOOK_SECRET')
+app.config['PROJECTS_PAGE_SIZE'] = int(os.environ.get('PROJECTS_PAGE_SIZE', 20))
 
 connect_db(app)
+metrics.connect_metrics(app)
 # db.create_all()
 
-# Connect and start the scheduler
+# Connect the scheduler, and start it unless the scheduled jobs run in a separate clock process (see clock.py)
 connect_scheduler(app)
-start_scheduler()
+if os.environ.get('RUN_SCHEDULER', '1') == '1':
+    start_scheduler()
 
 
 
-def check_user_session():
-    ''' A function that checks if the username exists in the session and if the username also exists in the database '''
-    return True if "username" in session and User.query.filter_by(username=session["username"]).first() else False
+@app.before_request
+def load_current_user():
+    ''' Loads the logged in user once per request into g.user, or None if no user is logged in '''
+    g.user = None
+    if "user_id" in session:
+        g.user = User.query.filter_by(id=session["user_id"]).first()
+    elif "username" in session:
+        # Sessions from before the user id was stored
+        g.user = User.query.filter_by(username=session["username"]).first()
+        if g.user:
+            log_in(g.user)
+
+
+def log_in(user):
+    session.pop("username", None)
+    session["user_id"] = user.id
+
+
+def login_required(view):
+    ''' Redirects to the home page unless a user is logged in '''
+    @functools.wraps(view)
+    def wrapper(*args, **kwargs):
+        if g.user is None:
+            return redirect("/")
+        return view(*args, **kwargs)
+    return wrapper
+
+
+RATE_LIMITED_MESSAGE = "We have reached the GitHub API rate limit, please try again in a few minutes."
         
 
 @app.route("/")
 def main_page():
     ''' The main route for that shows the home page  '''
-    if check_user_session():
-        user = User.query.filter_by(username=session["username"]).first()
-        return render_template("home.html", user= user)
+    if g.user:
+        return render_template("home.html", user= g.user)
     else:
         return render_template("index.html")
 
@@ -51,11 +87,21 @@ def register():
         is_organisation = form.is_organisation.data
 
         # validate if the git account exists and if the account is owned by the email provided by the user
-        if validate_git_handle_ownership(git_handle,email,is_organisation):
+        try:
+            owns_handle = validate_git_handle_ownership(git_handle,email,is_organisation)
+        except RateLimitExceeded:
+            form.git_handle.errors.append(RATE_LIMITED_MESSAGE)
+            return render_template(
+            "add_user_form.html", form=form)
+
+        if owns_handle:
             new_user = User.register(username=username, email=email, first_name=first_name,last_name=last_name, password=password, git_handle = git_handle, is_organisation = is_organisation)
             db.session.add(new_user)
+            db.session.flush()
+            # Link the projects the user already contributed to, from the contributors fetched by the scheduler
+            new_user.backfill_collaborations()
             db.session.commit()
-            session["username"] = new_user.username
+            log_in(new_user)
             flash(f"Welcome {first_name}")
             return redirect("/")
         else: 
@@ -80,7 +126,7 @@ def login():
         user = User.authenticate(username = username, password=password)
 
         if user:
-            session["username"] = user.username
+            log_in(user)
             return redirect(f"/")
 
         else:
@@ -92,41 +138,40 @@ def login():
 @app.route("/logout", methods=["POST"])
 def logout():
     ''' Function to Logout the user '''
-    session.pop("username")
+    session.pop("user_id", None)
+    session.pop("username", None)
 
     return redirect("/")
 
 @app.route("/profile")
+@login_required
 def show_profile():
     '''  A function that redirects to user's detail page '''
-    if check_user_session():
-
-        return redirect(f"/users/{session['username']}")
-    else:
-        return redirect("/")
+    return redirect(f"/users/{g.user.username}")
 
 
 @app.route("/users/<username>")
+@login_required
 def user_detail(username):
     ''' Shows user profile. It shows details like collaborations and owned projects '''
-    if check_user_session():
-        user = User.query.filter_by(username=username).first()
-        projects = user.owned_projects
-        collaborations = user.collaborations
-        is_self = True if user.username == session["username"] else False
-        return render_template("user.html", user = user, collaborations = collaborations, projects=projects, is_self = is_self)
-    else:
-        flash("Access unauthorized.", "danger")
-        return redirect("/")
+    user = g.user if username == g.user.username else User.query.filter_by(username=username).first_or_404()
+    # The cards show the sector of every project
+    projects = Project.query.options(joinedload(Project.sector)).filter_by(owned_by=user.username).order_by(Project.id).all()
+    collaborations = (Project.query.options(joinedload(Project.sector))
+                      .join(Collaboration, Collaboration.project_id == Project.id)
+                      .filter(Collaboration.username == user.username)
+                      .order_by(Project.id).all())
+    is_self = True if user.username == g.user.username else False
+    return render_template("user.html", user = user, collaborations = collaborations, projects=projects, is_self = is_self)
 
 @app.route("/users/<username>/delete", methods=["POST"])
+@login_required
 def delete_user(username):
     ''' Function to Delete the user '''
-    if check_user_session() and session["username"] == username:
-        user = User.query.filter_by(username=username).first()
-        db.session.delete(user)
+    if g.user.username == username:
+        db.session.delete(g.user)
         db.session.commit()
-        session.pop("username")
+        session.pop("user_id", None)
         return redirect("/")
 
     else:
@@ -134,10 +179,11 @@ def delete_user(username):
         return redirect("/")
 
 @app.route('/users/<username>/edit', methods=["GET", "POST"])
+@login_required
 def profile(username):
     """Update profile for current user."""
-    if check_user_session() and session["username"] == username:
-        user = User.query.filter_by(username=username).first()
+    if g.user.username == username:
+        user = g.user
         form = UserProfileForm(obj = user)
 
         if form.validate_on_submit():
@@ -158,317 +204,398 @@ def profile(username):
         return redirect("/")
 
 @app.route("/users/<username>/projects/add", methods=["GET", "POST"])
+@login_required
 def add_project(username):
     ''' Add new Project '''
-    if check_user_session():
+    user = g.user
+    form = AddProjectForm()
+    sectors = reference_data.refresh().sector_choices
+    form.sector.choices =  sectors
 
-        user = User.query.filter_by(username= username).first()
-        form = AddProjectForm()
-        sectors = [(sec.id, sec.name) for sec in Sector.query.all()]
-        form.sector.choices =  sectors
 
+    if form.validate_on_submit():
+        title = form.title.data
+        git_repo = form.git_repo.data
+        description = form.description.data
+        sector_id = form.sector.data
 
-        if form.validate_on_submit():
-            title = form.title.data
-            git_repo = form.git_repo.data
-            description = form.description.data
-            sector_id = form.sector.data
-
-            
-            # Check if the repository exists and is public
-
-            if not validate_repo_existence(git_repo):
-                form.git_repo.errors.append("The repository is private or doesn't exit")
-                return render_template(
-                "add_project_form.html", form=form)
+        
+        # Check if the repository exists and is public
 
-            # Check if the repository is owned by the user
-            if not git_repo.startswith(user.git_handle):
-                form.git_repo.errors.append("You can only add a repository that is owned by you")
-                return render_template(
-                "add_project_form.html", form=form)
-            
-            
-            # Create the project
+        try:
+            repo_exists = validate_repo_existence(git_repo)
+        except RateLimitExceeded:
+            form.git_repo.errors.append(RATE_LIMITED_MESSAGE)
+            return render_template(
+            "add_project_form.html", form=form)
 
-            new_project = Project(title=title, git_repo=git_repo, description=description, owned_by=session["username"], sector_id=sector_id)
-            db.session.add(new_project)
-            db.session.commit()
+        if not repo_exists:
+            form.git_repo.errors.append("The repository is private or doesn't exit")
+            return render_template(
+            "add_project_form.html", form=form)
 
-            # Add Current stacks in project
-            stacks =  get_stacks(git_repo)
-            stacks_in_db = Stack.query.filter(Stack.name.in_(stacks)).all()
-            new_project.stacks.extend(stacks_in_db)
+        # Check if the repository is owned by the user
+        if not git_repo.startswith(user.git_handle):
+            form.git_repo.errors.append("You can only add a repository that is owned by you")
+            return render_template(
+            "add_project_form.html", form=form)
+        
+        
+        # Create the project
 
-            # Add current collaborators in project
-            collabs =  get_collaborators(git_repo)
-            collabs_in_db = User.query.filter(User.git_handle.in_(collabs)).all()
-            new_project.collaborators.extend(collabs_in_db)
+        new_project = Project(title=title, git_repo=git_repo, description=description, owned_by=g.user.username, sector_id=sector_id, sync_status="syncing")
+        db.session.add(new_project)
+        db.session.flush()
+        UserProjectMatch.refresh(project_ids=[new_project.id])
 
-            db.session.commit()
-            flash(f"You created new project")
-            return redirect(f"/projects/{new_project.id}")
+        # The stacks and collaborators are fetched from GitHub by the job queue worker
+        enqueue_project_sync(new_project.id)
+        db.session.commit()
+        flash(f"You created new project")
+        return redirect(f"/projects/{new_project.id}")
 
-        else:
-            return render_template(
-                "add_project_form.html", form=form)
-    
     else:
-
-        return redirect("/")
-
+        return render_template(
+            "add_project_form.html", form=form)
 
 
 @app.route("/projects/<project_id>")
+@login_required
 def show_project(project_id):
     ''' Show project details '''
-    if check_user_session():
-        project = Project.query.get_or_404(project_id)
-        user = User.query.filter_by(username=session["username"]).first()
-        selfProject = True if user.username == project.owned_by else False
-        return render_template("project.html", project = project , selfProject=selfProject)
-    else:
-        return redirect("/")
+    project = (Project.query
+               .options(joinedload(Project.sector), selectinload(Project.stacks), selectinload(Project.collaborators))
+               .filter_by(id=project_id)
+               .first_or_404())
+    selfProject = True if g.user.username == project.owned_by else False
+    return render_template("project.html", project = project , selfProject=selfProject)
 
 @app.route("/projects", methods=["GET", "POST"])
+@login_required
 def show_projects():
     ''' Show registered projects. It also provide filtering with sector and stack or an option to see projects that are marked Preferred'''
-    if check_user_session():
-        
-        form = PreferenceForm()
+    
+    form = PreferenceForm()
 
-        # Get all the sectors and stacks and add them to the choices for mutiple field form inputs. 
-        sectors = [(sec.id, sec.name) for sec in Sector.query.all()]
-        stacks = [(sta.id, sta.name) for sta in Stack.query.all()]
-        form.sectors.choices =  sectors
-        form.stacks.choices = stacks
+    # Get all the sectors and stacks and add them to the choices for mutiple field form inputs. 
+    reference = reference_data.refresh()
+    sectors = reference.sector_choices
+    stacks = reference.stack_choices
+    form.sectors.choices =  sectors
+    form.stacks.choices = stacks
 
 
-        if form.validate_on_submit():
-            _sectors = form.sectors.data
-            _stacks = form.stacks.data
-            preferred_only = form.show_preferences_only.data
-
-            # If sector or stack filter is passed, filter projects by the stacks/sectors. And filter by preference depending on the preferred_only input.
-            if len(_sectors) > 0 or len(_stacks) > 0:
-                # Creates a query that filters the project with stacks and sectors selected by the user and not owned by the user.
-                query = (db.session.query(Project, ProjectStack, Stack, Sector, UserPreferenceSector, UserPreferenceStack)
-                .outerjoin(ProjectStack, Project.id == ProjectStack.project_id)
-                .outerjoin(Stack, ProjectStack.stack_id == Stack.id)
-                .outerjoin(Sector, Project.sector_id == Sector.id)
-                .outerjoin(UserPreferenceSector, (Project.sector_id == UserPreferenceSector.sector_id))
-                .outerjoin(UserPreferenceStack , (ProjectStack.stack_id == UserPreferenceStack.stack_id))
-                .filter((Project.owned_by != session["username"]) & ((Stack.id.in_(_stacks)) | (Sector.id.in_(_sectors)))))
-
-                # If preferred_only is true, filter out the query that have stack and sectors preferred by the user. 
-                # If preferred_only is false, don't filter the query further.  
-
-                if preferred_only:
-                    query = query.filter(  ((UserPreferenceStack.username == session["username"]) | (UserPreferenceSector.username == session["username"] )) ).all()
-                else:
-                    query = query.all()
-                
-                # Select the projects from the query, and use set to get unique projects.
-                filtered_projects = [q[0] for q in query]
-                filtered_projects = list(set(filtered_projects))
-                return render_template("projects.html", projects = filtered_projects, form = form)
-
-            # If sector or stack filter is not passed, but the preferred_only box is checked, filter out the projects only by preferred_only.
-            elif preferred_only:
-                query = (db.session.query(Project, ProjectStack , UserPreferenceSector, UserPreferenceStack)
-                .outerjoin(ProjectStack, Project.id == ProjectStack.project_id)
-                .outerjoin(UserPreferenceSector, (Project.sector_id == UserPreferenceSector.sector_id))
-                .outerjoin(UserPreferenceStack , (ProjectStack.stack_id == UserPreferenceStack.stack_id))
-                .filter((Project.owned_by != session["username"]))
-                .filter(((UserPreferenceStack.username == session["username"]) | (UserPreferenceSector.username == session["username"])))).all()
-
-                # Select the projects from the query, and use set to get unique projects.
-                filtered_projects = [q[0] for q in query]
-                filtered_projects = list(set(filtered_projects))
-                return render_template("projects.html", projects = filtered_projects, form = form)
-
-            # If sector or stack filter is not passed and preferred_only box is unchecked, return all projects not owned by the user. 
-            else:
-                # Get all projects not owned by the user
-                projects = Project.query.filter(Project.owned_by != session["username"]).all()
-                return render_template("projects.html", projects = projects, form = form)
-        # If it is a get request, return all the projects.
+    if form.validate_on_submit():
+        _sectors = form.sectors.data
+        _stacks = form.stacks.data
+        min_share = (form.min_share.data or 0) / 100
+        primary_only = form.primary_stack_only.data
+        preferred_only = form.show_preferences_only.data
+        search = (form.search.data or "").strip()
+
+        # Filter the projects not owned by the user by the search words and the stacks/sectors if any is passed, and by the user's preferences if preferred_only is checked.
+        query = Project.query.filter(Project.owned_by != g.user.username)
+        query, rank = filter_projects(query, _sectors, _stacks, min_share=min_share, primary_only=primary_only,
+                                      preferred_by=g.user.username if preferred_only else None, search=search)
+        projects, next_page = page_projects(query, rank, request.form.get("after"))
+        return render_template("projects.html", projects = projects, form = form, next_page = next_page)
+    # If it is a get request, return all the projects.
+    else:
+        # Get all projects not owned by the user
+        projects, next_page = page_projects(Project.query.filter(Project.owned_by != g.user.username), None, request.args.get("after"))
+        return render_template("projects.html", projects = projects, form = form, next_page = next_page)
+
+
+def filter_projects(query, sectors=(), stacks=(), min_share=0, primary_only=False, preferred_by=None, search=None):
+    ''' Filters a Project query with EXISTS subqueries, so every project comes once however many stacks and preferences it has.
+        Projects match one of the sectors or one of the stacks. A stack counts if it has at least min_share of the code,
+        and only if it is the project's primary stack with primary_only. With preferred_by, only the projects whose
+        sector or one of whose stacks that user prefers are kept, as recorded in UserProjectMatch. With search, only
+        the projects whose title or description has the words, in the web search syntax ("quoted phrase", or, -word).
+        Returns the query and the rank of the projects for page_projects: the text rank with search, else the
+        largest share of the matching stacks, else the preference score with preferred_by, else None '''
+    rank = None
+    if sectors or stacks:
+        stack_links = [ProjectStack.project_id == Project.id, ProjectStack.stack_id.in_(stacks)]
+        if min_share > 0:
+            stack_links.append(ProjectStack.share >= min_share)
+        if primary_only:
+            stack_links.append(ProjectStack.stack_id == Project.primary_stack_id)
+        query = query.filter(Project.sector_id.in_(sectors) | db.exists().where(*stack_links).correlate(Project))
+
+        if stacks:
+            rank = db.select(func.max(ProjectStack.share)).where(*stack_links).correlate(Project).scalar_subquery()
+
+    if search:
+        # Served by the GIN index on the search vector. The rank is cast to double precision so the cursor round-trips
+        words = func.websearch_to_tsquery("english", search)
+        query = query.filter(Project.search_vector.op("@@")(words))
+        rank = db.cast(func.ts_rank(Project.search_vector, words), db.Float)
+
+    if preferred_by:
+        matches = (UserProjectMatch.project_id == Project.id) & (UserProjectMatch.username == preferred_by)
+        if rank is None:
+            # Best matches first, read in order from the user's end of the matches index
+            query = query.join(UserProjectMatch, matches)
+            rank = UserProjectMatch.score
         else:
-            # Get all projects not owned by the user
-            projects = Project.query.filter(Project.owned_by != session["username"]).all()
-            return render_template("projects.html", projects = projects, form = form)
+            query = query.filter(db.exists().where(matches).correlate(Project))
+
+    return query, rank
+
+
+def page_projects(query, rank=None, after=None, size=None):
+    ''' Returns a page of the projects of a query and the cursor of the next page, or None on the last page.
+        The projects are ordered by descending rank, if any, then by id, and the cursor holds the sort key of the last
+        project of the page, so a page costs the same however deep it is. An invalid cursor gives the first page '''
+    size = size or app.config['PROJECTS_PAGE_SIZE']
+    if rank is None:
+        rank = db.cast(db.null(), db.Float)
+        query = query.order_by(Project.id)
     else:
-        return redirect("/")
+        query = query.order_by(rank.desc().nullslast(), Project.id)
+
+    try:
+        last_rank, last_id = after.split(",")
+        last_rank, last_id = float(last_rank) if last_rank else None, int(last_id)
+    except (AttributeError, ValueError):
+        pass
+    else:
+        if last_rank is None:
+            query = query.filter(rank.is_(None) & (Project.id > last_id))
+        else:
+            query = query.filter((rank < last_rank) | ((rank == last_rank) & (Project.id > last_id)) | rank.is_(None))
+
+    # The cards show the sector of every project
+    rows = query.options(joinedload(Project.sector)).add_columns(rank).limit(size + 1).all()
+    projects = [project for project, _ in rows[:size]]
+    if len(rows) <= size:
+        return projects, None
+    last_project, last_rank = rows[size - 1]
+    return projects, f"{'' if last_rank is None else repr(last_rank)},{last_project.id}"
+
 
 @app.route("/owned-projects", methods=["GET", "POST"])
+@login_required
 def show_own_projects():
     ''' Show projects that are owned by the user. It also provide filtering with sector and stack'''
-    if check_user_session():
-        
-        form = PreferenceFormOwnProject()
-        # Get all the sectors and stacks and add them to the choices for mutiple field form inputs. 
-        sectors = [(sec.id, sec.name) for sec in Sector.query.all()]
-        stacks = [(sta.id, sta.name) for sta in Stack.query.all()]
-        form.sectors.choices =  sectors
-        form.stacks.choices = stacks
+    
+    form = PreferenceFormOwnProject()
+    # Get all the sectors and stacks and add them to the choices for mutiple field form inputs. 
+    reference = reference_data.refresh()
+    sectors = reference.sector_choices
+    stacks = reference.stack_choices
+    form.sectors.choices =  sectors
+    form.stacks.choices = stacks
 
-        if form.validate_on_submit():
-            _sectors = form.sectors.data
-            _stacks = form.stacks.data
-
-            # If sector or stack filter is passed, filter projects by the stacks/sectors.
-            if len(_sectors) > 0 or len(_stacks) > 0:
-                query = (db.session.query(Project, ProjectStack, Stack, Sector)
-                .outerjoin(ProjectStack, Project.id == ProjectStack.project_id)
-                .outerjoin(Stack, ProjectStack.stack_id == Stack.id)
-                .outerjoin(Sector, Project.sector_id == Sector.id)
-                .filter((Project.owned_by == session["username"]) & ((Stack.id.in_(_stacks)) | (Sector.id.in_(_sectors))))).all()
-
-                # Select the projects from the query, and use set to get unique projects.
-
-                filtered_projects = [q[0] for q in query]
-                filtered_projects = list(set(filtered_projects))
-                return render_template("projects.html", projects = filtered_projects, username=session["username"], form = form)
-
-            # If sector or stack filter is not passed, return all the projects owned by the user. 
-            else:
-                # Get all projects owned by the user
-                projects = Project.query.filter(Project.owned_by == session["username"]).all()
-                return render_template("projects.html", projects = projects, username=session["username"], form = form)
-
-        # If it is a get request, return all the projects owned by the user.
-        else:
-            # Get all projects owned by the user
-            projects = Project.query.filter(Project.owned_by == session["username"]).all()
-            return render_template("projects.html", projects = projects, username=session["username"], form = form)
+    if form.validate_on_submit():
+        _sectors = form.sectors.data
+        _stacks = form.stacks.data
+
+        # Filter the projects owned by the user by the stacks/sectors if any is passed.
+        query, rank = filter_projects(Project.query.filter(Project.owned_by == g.user.username), _sectors, _stacks)
+        projects, next_page = page_projects(query, rank, request.form.get("after"))
+        return render_template("projects.html", projects = projects, username=g.user.username, form = form, next_page = next_page)
+
+    # If it is a get request, return all the projects owned by the user.
     else:
-        return redirect("/")
+        # Get all projects owned by the user
+        projects, next_page = page_projects(Project.query.filter(Project.owned_by == g.user.username), None, request.args.get("after"))
+        return render_template("projects.html", projects = projects, username=g.user.username, form = form, next_page = next_page)
 
 
 @app.route("/projects/<int:project_id>/update", methods=["GET", "POST"])
+@login_required
 def update_project(project_id):
     ''' Edit a project '''
-    if check_user_session():
-        user = User.query.filter_by(username= session["username"]).first()
-        project = Project.query.get_or_404(project_id)
-        form = AddProjectForm(obj=project)
+    user = g.user
+    project = Project.query.get_or_404(project_id)
+    form = AddProjectForm(obj=project)
 
-        form.sector.choices =  [(sec.id, sec.name) for sec in Sector.query.all()]
+    form.sector.choices =  reference_data.refresh().sector_choices
+    if not form.is_submitted():
         form.sector.data = project.sector_id
-        if form.validate_on_submit():
+    if form.validate_on_submit():
 
-            # Check if the repository exists and is public
+        # Check if the repository exists and is public. The current repository was checked when it was saved.
 
-            if not validate_repo_existence(form.git_repo.data):
-                form.git_repo.errors.append("The repository is private or doesn't exit")
+        if form.git_repo.data != project.git_repo:
+            try:
+                repo_exists = validate_repo_existence(form.git_repo.data)
+            except RateLimitExceeded:
+                form.git_repo.errors.append(RATE_LIMITED_MESSAGE)
                 return render_template(
                 "add_project_form.html", form=form)
 
-            # Check if the repository is owned by the user
-            if not form.git_repo.data.startswith(user.git_handle):
-                form.git_repo.errors.append("You can only add a repository that is owned by you")
+            if not repo_exists:
+                form.git_repo.errors.append("The repository is private or doesn't exit")
                 return render_template(
                 "add_project_form.html", form=form)
 
-            # update project
-            project.title = form.title.data
-            project.git_repo = form.git_repo.data
-            project.description = form.description.data
-            project.sector_id = form.sector.data
-            db.session.add(project)
-            db.session.commit()
-            flash(f"Project updated")
-            return redirect(f"/projects/{project.id}")
-
-        else:
+        # Check if the repository is owned by the user
+        if not form.git_repo.data.startswith(user.git_handle):
+            form.git_repo.errors.append("You can only add a repository that is owned by you")
             return render_template(
-                "add_project_form.html", form=form)
-    
-    else:
+            "add_project_form.html", form=form)
+
+        # update project, and fetch the stacks and collaborators again if it points at another repository
+        if form.git_repo.data != project.git_repo:
+            project.sync_status = "syncing"
+            enqueue_project_sync(project.id)
+        sector_changed = project.sector_id != form.sector.data
+        project.title = form.title.data
+        project.git_repo = form.git_repo.data
+        project.description = form.description.data
+        project.sector_id = form.sector.data
+        db.session.add(project)
+        if sector_changed:
+            UserProjectMatch.refresh(project_ids=[project.id])
+        db.session.commit()
+        flash(f"Project updated")
+        return redirect(f"/projects/{project.id}")
 
-        return redirect("/")
+    else:
+        return render_template(
+            "add_project_form.html", form=form)
 
 
 @app.route("/projects/<int:project_id>/delete", methods=["POST"])
+@login_required
 def delete_project(project_id):
     ''' Delete project'''
-    if check_user_session():
-        username = session["username"]
-        project = Project.query.get_or_404(project_id)
-        db.session.delete(project)
-        db.session.commit()
-        flash(f"Project deleted")
-        return redirect(f"/users/{username}")
+    username = g.user.username
+    project = Project.query.get_or_404(project_id)
+    db.session.delete(project)
+    db.session.commit()
+    flash(f"Project deleted")
+    return redirect(f"/users/{username}")
+
+
+@app.route("/status/github")
+def github_status():
+    ''' Shows the state of the GitHub rate limit governor to operators '''
+    return jsonify(github.governor.state())
+
+
+@app.route("/metrics")
+def show_metrics():
+    ''' Exposes the Prometheus metrics of the app, the GitHub calls and the jobs '''
+    body, content_type = metrics.render()
+    return body, 200, {"Content-Type": content_type}
+
+
+# GitHub webhooks
+
+WEBHOOK_EVENTS = ["push", "repository", "member"]
+
+
+def verify_webhook_signature(body, signature):
+    ''' Checks the X-Hub-Signature-256 header against the HMAC of the body with the webhook secret '''
+    secret = app.config['GITHUB_WEBHOOK_SECRET']
+    if not secret or not signature:
+        return False
+    expected = "sha256=" + hmac.new(secret.encode(), body, hashlib.sha256).hexdigest()
+    return hmac.compare_digest(expected, signature)
+
+
+@app.route("/webhooks/github", methods=["POST"])
+def github_webhook():
+    ''' Receives push, repository and member events from GitHub and queues a sync of the projects of the repository '''
+    if not verify_webhook_signature(request.get_data(), request.headers.get("X-Hub-Signature-256")):
+        return jsonify(message="Invalid signature"), 403
 
+    event = request.headers.get("X-GitHub-Event")
+    if event == "ping":
+        return jsonify(message="pong")
+    if event not in WEBHOOK_EVENTS:
+        return jsonify(message=f"Ignored {event} event"), 202
 
+    payload = request.get_json()
+    repo = payload["repository"]["full_name"]
 
+    # A renamed repository is still registered under its old name
+    if event == "repository" and payload.get("action") == "renamed":
+        old_repo = f"{payload['repository']['owner']['login']}/{payload['changes']['repository']['name']['from']}"
+        projects = Project.query.filter(func.lower(Project.git_repo) == old_repo.lower()).all()
+        for project in projects:
+            project.git_repo = repo
+        db.session.commit()
+    else:
+        projects = Project.query.filter(func.lower(Project.git_repo) == repo.lower()).all()
+
+    for project in projects:
+        enqueue_project_sync(project.id)
+    db.session.commit()
+    return jsonify(projects=[project.id for project in projects]), 202
 
 
 # Preferences
 
 @app.route("/preferences", methods=["GET", "POST"])
+@login_required
 def preferences():
-    if check_user_session():
-        user = User.query.filter_by(username=session["username"]).first()
-
-        # Get previously preferred stacks and sectors
-        user_prefered_stacks = user.prefered_stacks
-        user_prefered_sectors = user.prefered_sectors
-        prefered_stacks =[st.id for st in user_prefered_stacks]
-        prefered_sectors =[se.id for se in user_prefered_sectors]
-
-        # Get all the sectors and stacks and add them to the choices for mutiple field form inputs. 
-        form = PreferenceForm()
-        sectors = [(sec.id, sec.name) for sec in Sector.query.all()]
-        stacks = [(sta.id, sta.name) for sta in Stack.query.all()]
-        form.sectors.choices =  sectors
-        form.stacks.choices = stacks
-
-        
-        
-        if form.validate_on_submit():
-            _sectors = form.sectors.data
-            _stacks = form.stacks.data
+    user = g.user
+
+    # Get previously preferred stacks and sectors
+    user_prefered_stacks = user.prefered_stacks
+    user_prefered_sectors = user.prefered_sectors
+    prefered_stacks =[st.id for st in user_prefered_stacks]
+    prefered_sectors =[se.id for se in user_prefered_sectors]
+
+    # Get all the sectors and stacks and add them to the choices for mutiple field form inputs. 
+    form = PreferenceForm()
+    reference = reference_data.refresh()
+    sectors = reference.sector_choices
+    stacks = reference.stack_choices
+    form.sectors.choices =  sectors
+    form.stacks.choices = stacks
 
-            # Save new stacks and sectors preferences which are not part of previously added preferences
-            new_sectors = [se for se in _sectors if se not in prefered_sectors]
-            new_stacks = [st for st in _stacks if st not in prefered_stacks]
+    
+    
+    if form.validate_on_submit():
+        _sectors = form.sectors.data
+        _stacks = form.stacks.data
 
-            # Save stacks and sectors that will be deleted. Those are preferences that were part of previously added preferences 
-            # but are not selected now.
+        # Save new stacks and sectors preferences which are not part of previously added preferences
+        new_sectors = [se for se in _sectors if se not in prefered_sectors]
+        new_stacks = [st for st in _stacks if st not in prefered_stacks]
 
-            tobe_deleted_sectors = [se for se in prefered_sectors if se not in _sectors]
-            tobe_deleted_stacks = [st for st in prefered_stacks if st not in _stacks]
+        # Save stacks and sectors that will be deleted. Those are preferences that were part of previously added preferences 
+        # but are not selected now.
 
-            # Delete sectors
-            if len(tobe_deleted_sectors) > 0:
-                UserPreferenceSector.query.filter(UserPreferenceSector.sector_id.in_(tobe_deleted_sectors)).delete()
-                db.session.commit()
+        tobe_deleted_sectors = [se for se in prefered_sectors if se not in _sectors]
+        tobe_deleted_stacks = [st for st in prefered_stacks if st not in _stacks]
 
-            # Delete stacks
-            if len(tobe_deleted_stacks) > 0:
-                UserPreferenceStack.query.filter(UserPreferenceStack.stack_id.in_(tobe_deleted_stacks)).delete()
-                db.session.commit()
-            
-            # Add new sectors
-            if len(new_sectors) > 0:
-                sectors_in_db = Sector.query.filter(Sector.id.in_(new_sectors)).all()
-                user.prefered_sectors.extend(sectors_in_db)
-                db.session.commit()
+        # Delete sectors
+        if len(tobe_deleted_sectors) > 0:
+            UserPreferenceSector.query.filter(UserPreferenceSector.username == user.username,
+                                              UserPreferenceSector.sector_id.in_(tobe_deleted_sectors)).delete()
 
-            # Add new stacks
-            if len(new_stacks) > 0:
-                stacks_in_db = Stack.query.filter(Stack.id.in_(new_stacks)).all()
-                user.prefered_stacks.extend(stacks_in_db)
-                db.session.commit()
+        # Delete stacks
+        if len(tobe_deleted_stacks) > 0:
+            UserPreferenceStack.query.filter(UserPreferenceStack.username == user.username,
+                                             UserPreferenceStack.stack_id.in_(tobe_deleted_stacks)).delete()
+        
+        # Add new sectors
+        if len(new_sectors) > 0:
+            sectors_in_db = Sector.query.filter(Sector.id.in_(new_sectors)).all()
+            user.prefered_sectors.extend(sectors_in_db)
+
+        # Add new stacks
+        if len(new_stacks) > 0:
+            stacks_in_db = Stack.query.filter(Stack.id.in_(new_stacks)).all()
+            user.prefered_stacks.extend(stacks_in_db)
+
+        # Rescore the user's projects with the new preferences, in the same transaction
+        if new_sectors or new_stacks or tobe_deleted_sectors or tobe_deleted_stacks:
+            UserProjectMatch.refresh(usernames=[user.username])
+            db.session.commit()
 
 
-            return redirect("/preferences")
+        return redirect("/preferences")
 
-        else:
-            # On Get request, update form selection to the previously selected preferences 
-            form.stacks.data = prefered_stacks
-            form.sectors.data = prefered_sectors
-            return render_template("preferences.html", prefered_stacks = user_prefered_stacks, prefered_sectors= user_prefered_sectors, form = form)
     else:
-        return redirect("/")
\ No newline at end of file
+        # On Get request, update form selection to the previously selected preferences 
+        form.stacks.data = prefered_stacks
+        form.sectors.data = prefered_sectors
+        return render_template("preferences.html", prefered_stacks = user_prefered_stacks, prefered_sectors= user_prefered_sectors, form = form)
\ No newline at end of file
@@ -0,0 +1,20 @@
+''' The clock process: runs the scheduled jobs and the job queue worker, so the web workers don't have to.
+
+    RUN_SCHEDULER=0 gunicorn app:app
+    python clock.py
+
+Several clock processes can run at once. Each scheduled job takes a Postgres advisory lock, so a single process runs it.
+'''
+import os
+import time
+
+os.environ['RUN_SCHEDULER'] = '0'
+
+from app import app
+from schedule import start_scheduler
+
+
+if __name__ == "__main__":
+    start_scheduler()
+    while True:
+        time.sleep(3600)
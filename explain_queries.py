@@ -0,0 +1,136 @@
+''' Runs EXPLAIN on the queries of the key routes and jobs, and flags the sequential scans of the tables that grow with
+the users and the projects.
+
+    python explain_queries.py [--user <username>] [--no-seqscan]
+
+The routes are requested as the user (by default the first user who owns a project) with the test client, and every
+statement they send is captured and explained, so the plans are those of the queries the app really builds. Nothing
+is written. Exits with status 1 if a plan reads one of those tables whole: with a sequential scan, or with an index
+scan that has no index condition and filters out most of the rows, which an index on the filtered columns would serve.
+
+On a few rows Postgres rightly prefers sequential scans, so run it against a database of realistic size
+(scripts/bench_projects_filter.py seeds one), or with --no-seqscan, which makes Postgres use an index wherever one
+can serve the query: a table still read whole then means a missing index.
+'''
+import argparse
+import sys
+from sqlalchemy import event, text
+from app import app
+from models import db, User, Project, Collaboration, ProjectContributor, ProjectStack
+from schedule import load_links
+
+# Reference tables, small enough to be read whole
+SMALL_TABLES = {"sectors", "stacks", "reference_versions", "schema_migrations"}
+
+
+# An index scan without an index condition whose filter keeps less than this share of the table reads it whole for little
+SELECTIVE_FILTER = 0.1
+
+
+def full_scans(plan, sizes):
+    ''' Returns the tables a JSON plan reads whole. `sizes` holds the estimated rows of the tables '''
+    tables = set()
+    node = plan.get("Node Type")
+    if node == "Seq Scan":
+        tables.add(plan["Relation Name"])
+    elif node in ("Index Scan", "Index Only Scan") and "Index Cond" not in plan and "Filter" in plan:
+        if plan["Plan Rows"] < SELECTIVE_FILTER * sizes.get(plan["Relation Name"], 0):
+            tables.add(plan["Relation Name"])
+    for child in plan.get("Plans", []):
+        tables |= full_scans(child, sizes)
+    return tables
+
+
+def capture_statements(run):
+    ''' Calls `run` and returns the [(statement, parameters)] it sent to the database '''
+    statements = []
+
+    def capture(conn, cursor, statement, parameters, context, executemany):
+        if not executemany:
+            statements.append((statement, parameters))
+
+    event.listen(db.engine, "before_cursor_execute", capture)
+    try:
+        run()
+    finally:
+        event.remove(db.engine, "before_cursor_execute", capture)
+    return statements
+
+
+def key_statements(user):
+    ''' [(label, statement, parameters)] of the key routes, as `user`, and of the jobs '''
+    project = (Project.query.filter_by(owned_by=user.username).order_by(Project.id).first()
+               or Project.query.order_by(Project.id).first())
+    stack_ids = [stack_id for (stack_id,) in db.session.query(ProjectStack.stack_id).filter_by(project_id=project.id).limit(2)]
+    project_ids = [project_id for (project_id,) in db.session.query(Project.id).order_by(Project.id).limit(100)]
+    requests = [("GET /projects", "get", "/projects", None),
+                ("POST /projects, stacks", "post", "/projects", {"stacks": stack_ids[:1]}),
+                ("POST /projects, stacks and sector, min share", "post", "/projects",
+                 {"stacks": stack_ids, "sectors": [project.sector_id], "min_share": 20}),
+                ("POST /projects, primary stack", "post", "/projects", {"stacks": stack_ids[:1], "primary_stack_only": "y"}),
+                ("POST /projects, preferred only", "post", "/projects", {"show_preferences_only": "y"}),
+                ("GET /owned-projects", "get", "/owned-projects", None),
+                ("GET /users/<username>", "get", f"/users/{user.username}", None),
+                ("GET /projects/<id>", "get", f"/projects/{project.id}", None),
+                ("GET /preferences", "get", "/preferences", None)]
+
+    found = []
+    app.config['WTF_CSRF_ENABLED'] = False
+    with app.test_client() as client:
+        with client.session_transaction() as sess:
+            sess["user_id"] = user.id
+        for label, method, url, data in requests:
+            statements = capture_statements(lambda: getattr(client, method)(url, data=data))
+            found.extend((label, statement, parameters) for statement, parameters in statements)
+
+    def sync_jobs():
+        load_links(ProjectContributor, "login", project_ids)
+        load_links(Collaboration, "username", project_ids)
+        user.backfill_collaborations()
+        db.session.rollback()
+    found.extend(("sync jobs", statement, parameters) for statement, parameters in capture_statements(sync_jobs))
+    return found
+
+
+def explain(statement, parameters, seqscan=True):
+    with db.engine.connect() as conn, conn.begin() as transaction:
+        if not seqscan:
+            conn.execute(text("SET LOCAL enable_seqscan = off"))
+        plan = conn.exec_driver_sql("EXPLAIN (FORMAT JSON) " + statement, parameters).scalar()
+        transaction.rollback()
+    return plan[0]["Plan"]
+
+
+def check(user, seqscan=True):
+    ''' Returns [(label, statement, tables)] of the key statements that read large tables whole '''
+    sizes = dict(db.session.execute(text("SELECT relname, reltuples FROM pg_class WHERE relkind = 'r'")).all())
+    flagged = []
+    for label, statement, parameters in key_statements(user):
+        tables = full_scans(explain(statement, parameters, seqscan), sizes) - SMALL_TABLES
+        if tables:
+            flagged.append((label, statement, tables))
+    return flagged
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Flag the sequential scans of the key queries")
+    parser.add_argument("--user", help="Username to request the routes as")
+    parser.add_argument("--no-seqscan", action="store_true", help="Discourage sequential scans to find missing indexes")
+    args = parser.parse_args()
+
+    app.config['SQLALCHEMY_ECHO'] = False
+    with app.app_context():
+        if args.user:
+            user = User.query.filter_by(username=args.user).one()
+        else:
+            user = User.query.filter(User.username.in_(db.session.query(Project.owned_by))).order_by(User.id).first()
+        flagged = check(user, seqscan=not args.no_seqscan)
+        for label, statement, tables in flagged:
+            print(f"{label}: reads {', '.join(sorted(tables))} whole")
+            print("    " + " ".join(statement.split())[:300])
+        print(f"{len(flagged)} statements read large tables whole")
+    sys.exit(1 if flagged else 0)
+
+
+if __name__ == "__main__":
+    main()
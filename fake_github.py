@@ -0,0 +1,291 @@
+''' A local stand-in for the GitHub API, for deterministic tests and for benchmarking the scheduler at scale.
+
+It serves /repos/{repo}, /repos/{repo}/languages, /repos/{repo}/contributors (paginated, with ETags),
+/users/{handle}, /orgs/{handle} and the /graphql repository queries of git.fetch_repo_metadata,
+with configurable latency, error rate and rate limit headers. Point git.GIT_API_BASE_URL
+(or the GIT_API_BASE_URL environment variable) at its base_url.
+
+Responses can also be recorded from the real API once and replayed afterwards:
+
+    python fake_github.py --fixtures fixtures/github.json --record    # proxies to api.github.com and saves the responses
+    python fake_github.py --fixtures fixtures/github.json             # replays them
+'''
+import argparse
+import hashlib
+import json
+import os
+import random
+import re
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlsplit, parse_qs
+
+import requests
+
+UPSTREAM_URL = "https://api.github.com"
+
+# Headers kept when a response is recorded
+RECORDED_HEADERS = ["Content-Type", "ETag", "Last-Modified", "Link"]
+
+
+class FakeGitHub:
+    ''' The state of the fake GitHub service and the HTTP server serving it '''
+
+    def __init__(self, latency=0, error_rate=0, rate_limit=None, fixtures=None, record=False, port=0):
+        self.latency = latency
+        self.error_rate = error_rate
+        self.rate_limit = rate_limit
+        self.fixtures = fixtures
+        self.record = record
+        self.port = port
+        self.repos = {}
+        self.users = {}
+        self.orgs = {}
+        self.requests = []
+        self.recordings = {}
+        self.buckets = {}
+        self.server = None
+        self._lock = threading.Lock()
+
+        if fixtures and os.path.exists(fixtures):
+            with open(fixtures) as f:
+                self.recordings = json.load(f)
+
+    # Data
+
+    def add_repo(self, repo, languages=None, contributors=None, pushed_at="2022-01-01T00:00:00Z"):
+        ''' Adds a public repository with its languages ({name: bytes}) and contributors (logins) '''
+        self.repos[repo.lower()] = {"full_name": repo, "languages": languages or {}, "contributors": contributors or [], "pushed_at": pushed_at}
+
+    def add_user(self, handle, email=None):
+        self.users[handle.lower()] = {"login": handle, "email": email}
+
+    def add_org(self, handle, email=None):
+        self.orgs[handle.lower()] = {"login": handle, "email": email}
+
+    def populate(self, count, languages=("Python", "JavaScript", "Go", "Rust", "C"), contributors=250, owner="owner"):
+        ''' Adds `count` synthetic repositories, for benchmarks '''
+        for i in range(count):
+            self.add_repo(f"{owner}/repo{i}",
+                          languages={name: (i + 1) * (j + 1) * 100 for j, name in enumerate(languages[:1 + i % len(languages)])},
+                          contributors=[f"user{(i + j) % (count + contributors)}" for j in range(1 + i % contributors)])
+
+    # Server
+
+    def start(self):
+        ''' Starts serving on localhost in a background thread and returns the base URL '''
+        fake = self
+
+        class Handler(FakeGitHubHandler):
+            github = fake
+
+        self.server = ThreadingHTTPServer(("127.0.0.1", self.port), Handler)
+        self.server.daemon_threads = True
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        return self.base_url
+
+    def stop(self):
+        if self.server:
+            self.server.shutdown()
+            self.server.server_close()
+            self.server = None
+        self.save()
+
+    @property
+    def base_url(self):
+        return f"http://127.0.0.1:{self.server.server_port}"
+
+    def save(self):
+        ''' Writes the recorded responses to the fixtures file '''
+        if self.record and self.fixtures:
+            with open(self.fixtures, "w") as f:
+                json.dump(self.recordings, f, indent=2, sort_keys=True)
+
+    # Rate limit
+
+    def take_token(self, resource, charge=True):
+        ''' Charges a request to the resource's budget and returns its rate limit headers, or None when it is exhausted '''
+        if self.rate_limit is None:
+            return {}
+        with self._lock:
+            now = int(time.time())
+            bucket = self.buckets.get(resource)
+            if bucket is None or now >= bucket["reset"]:
+                bucket = self.buckets[resource] = {"remaining": self.rate_limit, "reset": now + 3600}
+            if charge and bucket["remaining"] == 0:
+                return None
+            if charge:
+                bucket["remaining"] -= 1
+            return {"X-RateLimit-Limit": str(self.rate_limit), "X-RateLimit-Remaining": str(bucket["remaining"]),
+                    "X-RateLimit-Reset": str(bucket["reset"]), "X-RateLimit-Resource": resource}
+
+
+class FakeGitHubHandler(BaseHTTPRequestHandler):
+    ''' Serves the requests of one FakeGitHub '''
+
+    github = None
+
+    def log_message(self, *args):
+        pass
+
+    def do_GET(self):
+        self.handle_request("GET")
+
+    def do_POST(self):
+        self.handle_request("POST")
+
+    def handle_request(self, method):
+        fake = self.github
+        fake.requests.append((method, self.path))
+        if fake.latency:
+            time.sleep(fake.latency)
+        if fake.error_rate and random.random() < fake.error_rate:
+            return self.answer(502, {"message": "Server Error"}, charge=False)
+
+        resource = "graphql" if self.path.startswith("/graphql") else "core"
+        if method == "POST" and resource == "graphql":
+            body = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))) or b"{}")
+            return self.answer(200, self.graphql(body), resource=resource)
+
+        key = f"{method} {self.path}"
+        if key in fake.recordings:
+            recorded = fake.recordings[key]
+            return self.answer(recorded["status"], recorded["body"], recorded["headers"], resource=resource)
+
+        if fake.record:
+            return self.proxy(key, resource)
+
+        status, body, headers = self.route()
+        self.answer(status, body, headers, resource=resource)
+
+    def answer(self, status, body, headers=None, resource="core", charge=True):
+        ''' Sends a JSON response, with an ETag for conditional requests and the rate limit headers '''
+        headers = dict(headers or {})
+        data = json.dumps(body).encode() if body is not None else b""
+        if status == 200 and "ETag" not in headers:
+            headers["ETag"] = '"' + hashlib.sha1(data).hexdigest() + '"'
+
+        not_modified = status == 200 and self.headers.get("If-None-Match") == headers["ETag"]
+        rate_headers = self.github.take_token(resource, charge=charge and not not_modified)
+        if rate_headers is None:
+            status, data, headers, not_modified = 403, b'{"message": "API rate limit exceeded"}', {}, False
+            rate_headers = self.github.take_token(resource, charge=False)
+        if not_modified:
+            status, data = 304, b""
+
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json; charset=utf-8")
+        for name, value in {**headers, **rate_headers}.items():
+            if name != "Content-Type":
+                self.send_header(name, value)
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def route(self):
+        ''' Returns (status, body, headers) for a REST GET from the data of the fake '''
+        fake = self.github
+        url = urlsplit(self.path)
+        query = parse_qs(url.query)
+        not_found = (404, {"message": "Not Found"}, {})
+
+        match = re.fullmatch(r"/(users|orgs)/([^/]+)", url.path)
+        if match:
+            accounts = fake.users if match.group(1) == "users" else fake.orgs
+            account = accounts.get(match.group(2).lower())
+            return (200, account, {}) if account else not_found
+
+        match = re.fullmatch(r"/repos/([^/]+/[^/]+)(/languages|/contributors)?", url.path)
+        if not match or match.group(1).lower() not in fake.repos:
+            return not_found
+        repo = fake.repos[match.group(1).lower()]
+
+        if match.group(2) is None:
+            return 200, {"full_name": repo["full_name"], "private": False, "pushed_at": repo["pushed_at"]}, {}
+
+        if match.group(2) == "/languages":
+            return 200, repo["languages"], {}
+
+        # Contributors, paginated like GitHub with Link headers
+        contributors = repo["contributors"]
+        if not contributors:
+            return 204, None, {}
+        per_page = int(query.get("per_page", ["30"])[0])
+        page = int(query.get("page", ["1"])[0])
+        last = (len(contributors) + per_page - 1) // per_page
+        body = [{"login": login, "contributions": 1} for login in contributors[(page - 1) * per_page:page * per_page]]
+        links = []
+        base = f"http://{self.headers['Host']}{url.path}?per_page={per_page}"
+        if page < last:
+            links.append(f'<{base}&page={page + 1}>; rel="next"')
+            links.append(f'<{base}&page={last}>; rel="last"')
+        return 200, body, {"Link": ", ".join(links)} if links else {}
+
+    def graphql(self, body):
+        ''' Answers the aliased repository queries built by git.build_repo_metadata_query '''
+        variables = body.get("variables", {})
+        data = {}
+        errors = []
+        i = 0
+        while f"owner{i}" in variables:
+            name = f"{variables[f'owner{i}']}/{variables[f'name{i}']}"
+            repo = self.github.repos.get(name.lower())
+            if repo is None:
+                data[f"r{i}"] = None
+                errors.append({"type": "NOT_FOUND", "path": [f"r{i}"], "message": f"Could not resolve to a Repository with the name '{name}'."})
+            else:
+                node = {"pushedAt": repo["pushed_at"]}
+                if variables.get("withLanguages"):
+                    node["languages"] = {"edges": [{"size": size, "node": {"name": lang}} for lang, size in
+                                                   sorted(repo["languages"].items(), key=lambda item: -item[1])]}
+                if variables.get("withCollaborators"):
+                    contributors = repo["contributors"]
+                    node["defaultBranchRef"] = {"target": {"history": {
+                        "pageInfo": {"hasNextPage": len(contributors) > 100},
+                        "nodes": [{"author": {"user": {"login": login}}} for login in contributors[:100]]}}} if contributors else None
+                data[f"r{i}"] = node
+            i += 1
+        return {"data": data, "errors": errors} if errors else {"data": data}
+
+    def proxy(self, key, resource):
+        ''' Forwards a GET to the real GitHub API and records the response '''
+        fake = self.github
+        headers = {"Accept": "application/vnd.github.v3+json"}
+        if os.environ.get("GIT_TOKEN"):
+            headers["Authorization"] = f"token {os.environ['GIT_TOKEN']}"
+        resp = requests.get(UPSTREAM_URL + self.path, headers=headers)
+
+        recorded_headers = {name: resp.headers[name] for name in RECORDED_HEADERS if name in resp.headers}
+        if "Link" in recorded_headers:
+            recorded_headers["Link"] = recorded_headers["Link"].replace(UPSTREAM_URL, f"http://{self.headers['Host']}")
+        body = resp.json() if resp.content else None
+        fake.recordings[key] = {"status": resp.status_code, "headers": recorded_headers, "body": body}
+        fake.save()
+        self.answer(resp.status_code, body, recorded_headers, resource=resource)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Run a local stand-in for the GitHub API")
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--latency", type=float, default=0, help="Seconds added to every response")
+    parser.add_argument("--error-rate", type=float, default=0, help="Share of requests answered with a 502")
+    parser.add_argument("--rate-limit", type=int, default=None, help="Requests per hour and resource, unlimited by default")
+    parser.add_argument("--fixtures", help="JSON file of recorded responses")
+    parser.add_argument("--record", action="store_true", help="Proxy unknown requests to api.github.com and record them")
+    parser.add_argument("--populate", type=int, default=0, help="Number of synthetic repositories to serve")
+    args = parser.parse_args()
+
+    fake = FakeGitHub(latency=args.latency, error_rate=args.error_rate, rate_limit=args.rate_limit,
+                      fixtures=args.fixtures, record=args.record, port=args.port)
+    fake.populate(args.populate)
+    print(f"Serving a fake GitHub API on {fake.start()}, set GIT_API_BASE_URL to use it")
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        fake.stop()
+
+
+if __name__ == "__main__":
+    main()
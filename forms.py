@@ -1,6 +1,6 @@
 from flask_wtf import FlaskForm
-from wtforms import StringField, PasswordField, EmailField, SelectField, SelectMultipleField, BooleanField
-from wtforms.validators import InputRequired, Email, Regexp
+from wtforms import StringField, PasswordField, EmailField, SelectField, SelectMultipleField, BooleanField, IntegerField
+from wtforms.validators import InputRequired, Email, Regexp, Optional, NumberRange
 class RegisterUserForm(FlaskForm):
     """Form for creating users."""
 
@@ -53,8 +53,11 @@ class SectorPreferenceForm(FlaskForm):
 class PreferenceForm(FlaskForm):
     """Form for filtering Preference"""
 
+    search = StringField("Search the titles and descriptions", validators=[Optional()])
     sectors = SelectMultipleField('What sector are you interested in ? ', coerce=int)
     stacks = SelectMultipleField('What stack are you interested in ? ', coerce=int)
+    min_share = IntegerField("Minimum share of the stack in the code (%)", validators=[Optional(), NumberRange(min=0, max=100)])
+    primary_stack_only = BooleanField("Only projects written mostly in the stack")
     show_preferences_only = BooleanField("Show preferred projects only") 
 
 
@@ -1,71 +1,515 @@
 import requests
+import itertools
 import json
+import logging
+import math
 import os
+import threading
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
+from datetime import datetime
+from flask import has_app_context
+from requests.adapters import HTTPAdapter
+from sqlalchemy.dialects.postgresql import insert
+from urllib3.util.retry import Retry
+from models import db, GitResponseCache
+import metrics
 
-GIT_API_BASE_URL = "https://api.github.com"
+GIT_API_BASE_URL = os.environ.get('GIT_API_BASE_URL', "https://api.github.com")
 TOKEN=os.environ.get('GIT_TOKEN')
 
-def get_stacks(repo):
-    ''' Returns the languages used in the repo '''
+# Upper bound on the pages of 100 contributors read per repository
+MAX_CONTRIBUTOR_PAGES = int(os.environ.get('GIT_MAX_CONTRIBUTOR_PAGES', 10))
+
+# Number of repositories fetched per GraphQL query by fetch_repo_metadata
+GRAPHQL_BATCH_SIZE = int(os.environ.get('GIT_GRAPHQL_BATCH_SIZE', 25))
+
+# Priority lanes for GitHub calls. Routes run in the interactive lane, the scheduler jobs in the background lane.
+INTERACTIVE = "interactive"
+BACKGROUND = "background"
+
+logger = logging.getLogger(__name__)
+
+
+class GitHubError(Exception):
+    ''' Raised when GitHub does not answer a request with a usable response '''
+
+    def __init__(self, url, status_code):
+        self.url = url
+        self.status_code = status_code
+        super().__init__(f"GitHub answered {status_code} for {url}")
+
+
+class RateLimitExceeded(GitHubError):
+    ''' Raised when the GitHub rate limit leaves no budget for the calling lane '''
+
+    def __init__(self, reset_at):
+        self.reset_at = reset_at
+        self.status_code = 403
+        Exception.__init__(self, f"GitHub rate limit exhausted until {datetime.utcfromtimestamp(reset_at).isoformat()}Z")
+
+
+class RateLimitBucket:
+    ''' The budget of one GitHub rate limit resource (core, graphql, ...) '''
+
+    def __init__(self):
+        self.limit = None
+        self.remaining = None
+        self.reset_at = None
+        self.paused_until = None
+
+
+class RateLimitGovernor:
+    ''' A token bucket per GitHub rate limit resource that mirrors the rate limit.
+        Every call takes a token, and the bucket is resynced from the X-RateLimit-* headers of every response.
+        A share of the budget is reserved for the interactive lane, so background calls wait for the reset
+        once the budget drops to the reserve, and interactive calls only fail when it is fully spent '''
+
+    def __init__(self, interactive_reserve=0.2, max_background_wait=3600):
+        self.interactive_reserve = interactive_reserve
+        self.max_background_wait = max_background_wait
+        self.buckets = {}
+        self.rejected = {INTERACTIVE: 0, BACKGROUND: 0}
+        self._lock = threading.Lock()
+        self._local = threading.local()
+
+    @contextmanager
+    def lane(self, name):
+        ''' Runs the calls made by this thread inside the block in the given lane '''
+        previous = self.current_lane()
+        self._local.lane = name
+        try:
+            yield
+        finally:
+            self._local.lane = previous
+
+    def current_lane(self):
+        return getattr(self._local, "lane", INTERACTIVE)
+
+    def bucket(self, resource="core"):
+        return self.buckets.setdefault(resource, RateLimitBucket())
+
+    def _floor(self, bucket, lane):
+        ''' The number of tokens the lane must leave in the bucket '''
+        if lane == INTERACTIVE or not bucket.limit:
+            return 0
+        return math.ceil(bucket.limit * self.interactive_reserve)
+
+    def acquire(self, resource="core"):
+        ''' Takes a token for the current lane. Background calls sleep until the reset when the budget is down to the reserve '''
+        lane = self.current_lane()
+        while True:
+            with self._lock:
+                bucket = self.bucket(resource)
+                now = time.time()
+                if bucket.reset_at and now >= bucket.reset_at:
+                    # The window has been reset, the next response tells us the new budget
+                    bucket.remaining = None
+                    bucket.reset_at = None
+                    bucket.paused_until = None
+
+                if bucket.remaining is None or bucket.remaining > self._floor(bucket, lane):
+                    if bucket.remaining is not None:
+                        bucket.remaining -= 1
+                    return
+
+                reset_at = bucket.reset_at
+                wait = reset_at - now
+                if lane == INTERACTIVE or wait > self.max_background_wait:
+                    self.rejected[lane] += 1
+                    raise RateLimitExceeded(reset_at)
+                bucket.paused_until = reset_at
+
+            logger.warning("GitHub %s budget is down to the interactive reserve, pausing background calls for %.0fs", resource, wait)
+            time.sleep(wait + 1)
+
+    def update(self, resp, resource="core"):
+        ''' Resyncs the bucket from the rate limit headers of a response. Returns True if the response is a rate limit answer '''
+        headers = resp.headers
+        with self._lock:
+            bucket = self.bucket(headers.get("X-RateLimit-Resource", resource))
+            if "X-RateLimit-Remaining" in headers:
+                bucket.limit = int(headers.get("X-RateLimit-Limit", bucket.limit or 0))
+                bucket.remaining = int(headers["X-RateLimit-Remaining"])
+                bucket.reset_at = int(headers.get("X-RateLimit-Reset", time.time() + 3600))
+
+            # Primary and secondary rate limit answers
+            if resp.status_code in (403, 429) and (bucket.remaining == 0 or "Retry-After" in headers):
+                bucket.remaining = 0
+                retry_after = headers.get("Retry-After")
+                if retry_after:
+                    bucket.reset_at = max(bucket.reset_at or 0, int(time.time()) + int(retry_after))
+                logger.warning("GitHub rate limit hit, %s budget exhausted until %s", resource, bucket.reset_at)
+                return True
+        return False
+
+    def reset_at(self, resource="core"):
+        return self.bucket(resource).reset_at
+
+    def state(self):
+        ''' The current state of the buckets, for operators '''
+        def iso(ts):
+            return datetime.utcfromtimestamp(ts).isoformat() + "Z" if ts else None
+
+        with self._lock:
+            return {
+                "buckets": {resource: {
+                    "limit": bucket.limit,
+                    "remaining": bucket.remaining,
+                    "reset_at": iso(bucket.reset_at),
+                    "interactive_reserve": self._floor(bucket, BACKGROUND),
+                    "background_paused_until": iso(bucket.paused_until),
+                } for resource, bucket in self.buckets.items()},
+                "rejected": dict(self.rejected),
+            }
+
+
+class ValidatorCache:
+    ''' Stores the ETag/Last-Modified validators and the parsed body of GitHub responses in the git_response_cache table.
+        Outside of an app context there is no database, so the cache does nothing '''
+
+    def load(self, url):
+        if not has_app_context():
+            return None
+        with db.engine.connect() as conn:
+            return conn.execute(GitResponseCache.__table__.select().where(GitResponseCache.url == url)).first()
+
+    def store(self, url, etag, last_modified, payload, next_url=None):
+        if not has_app_context() or not (etag or last_modified):
+            return
+        values = dict(etag=etag, last_modified=last_modified, payload=payload, next_url=next_url, fetched_at=datetime.utcnow())
+        stmt = insert(GitResponseCache.__table__).values(url=url, **values)
+        with db.engine.begin() as conn:
+            conn.execute(stmt.on_conflict_do_update(index_elements=[GitResponseCache.url], set_=values))
+
+
+class GitHubClient:
+    ''' A reusable client for the GitHub API. It keeps a pooled keep-alive session so connections are reused between calls '''
+
+    def __init__(self, token=TOKEN, pool_size=10, connect_timeout=3.05, read_timeout=10, retries=3, backoff_factor=0.5, cache=None, governor=None):
+        self.cache = cache
+        self.governor = governor or RateLimitGovernor()
+        self.timeout = (connect_timeout, read_timeout)
+        self.session = requests.Session()
+        self.session.headers.update({'Accept': 'application/vnd.github.v3+json'})
+        if token:
+            self.session.headers['Authorization'] = f'token {token}'
+
+        # Retry connection errors and 5xx responses with an exponential backoff, then hand the last response back to the caller.
+        # POST is only used for GraphQL queries, which are read only and safe to retry.
+        retry = Retry(total=retries,
+                      backoff_factor=backoff_factor,
+                      status_forcelist=(500, 502, 503, 504),
+                      allowed_methods=frozenset(['GET', 'HEAD', 'POST']),
+                      raise_on_status=False)
+        adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size, max_retries=retry)
+        self.session.mount("https://", adapter)
+        self.session.mount("http://", adapter)
+
+    def request(self, method, url, resource="core", **kwargs):
+        ''' Sends a request through the pooled session, within the budget of the current lane for the rate limit resource '''
+        kwargs.setdefault("timeout", self.timeout)
+        while True:
+            self.governor.acquire(resource)
+            start = time.perf_counter()
+            resp = self.session.request(method, url, **kwargs)
+            metrics.observe_github_call(resp, resource, time.perf_counter() - start)
+            if not self.governor.update(resp, resource):
+                return resp
+            # Background calls go back to the governor, which pauses them until the reset
+            if self.governor.current_lane() == INTERACTIVE:
+                raise RateLimitExceeded(self.governor.reset_at(resource))
+
+    def get(self, url, **kwargs):
+        return self.request("GET", url, **kwargs)
+
+    def post(self, url, **kwargs):
+        return self.request("POST", url, **kwargs)
+
+    def get_json(self, url, parse=None):
+        ''' Conditionally GETs a JSON resource and returns (status_code, payload).
+            The validators of the last response are sent as If-None-Match / If-Modified-Since, and on a 304
+            the cached payload is returned with a 200 status. `parse` reduces the body before it is cached '''
+        status, payload, _ = self._get_page(url, parse)
+        return status, payload
+
+    def iter_pages(self, url, parse=None, max_pages=None):
+        ''' Yields the payload of every page of a paginated resource, following the rel="next" Link headers.
+            Every page is requested conditionally like in get_json. Raises GitHubError if a page can't be fetched '''
+        pages = 0
+        while url and (max_pages is None or pages < max_pages):
+            status, payload, next_url = self._get_page(url, parse)
+            if status == 204:
+                return
+            if status != 200:
+                raise GitHubError(url, status)
+            pages += 1
+            yield payload
+            url = next_url
+
+    def _get_page(self, url, parse=None):
+        ''' Returns (status_code, payload, next_url) for a conditional GET of one page '''
+        cached = self.cache.load(url) if self.cache else None
+        headers = {}
+        if cached:
+            if cached.etag:
+                headers["If-None-Match"] = cached.etag
+            if cached.last_modified:
+                headers["If-Modified-Since"] = cached.last_modified
+
+        resp = self.get(url, headers=headers)
+
+        if resp.status_code == 304 and cached:
+            return 200, cached.payload, cached.next_url
+
+        if resp.status_code == 200:
+            payload = parse(resp.json()) if parse else resp.json()
+            next_url = resp.links.get("next", {}).get("url")
+            if self.cache:
+                self.cache.store(url, resp.headers.get("ETag"), resp.headers.get("Last-Modified"), payload, next_url)
+            return 200, payload, next_url
+
+        return resp.status_code, None, None
+
+    def close(self):
+        self.session.close()
+
+
+# Shared client used by the helpers below, the routes and the scheduler jobs
+github = GitHubClient(pool_size=int(os.environ.get('GIT_POOL_SIZE', 10)),
+                      connect_timeout=float(os.environ.get('GIT_CONNECT_TIMEOUT', 3.05)),
+                      read_timeout=float(os.environ.get('GIT_READ_TIMEOUT', 10)),
+                      retries=int(os.environ.get('GIT_RETRIES', 3)),
+                      backoff_factor=float(os.environ.get('GIT_RETRY_BACKOFF', 0.5)),
+                      cache=ValidatorCache(),
+                      governor=RateLimitGovernor(interactive_reserve=float(os.environ.get('GIT_INTERACTIVE_RESERVE', 0.2)),
+                                                 max_background_wait=float(os.environ.get('GIT_MAX_BACKGROUND_WAIT', 3600))))
+
+
+@metrics.github_function
+def get_languages(repo):
+    ''' Returns the languages used in the repo with their size in bytes '''
     url = f"{GIT_API_BASE_URL}/repos/{repo}/languages"
-    headers = {'Accept': 'application/vnd.github.v3+json', 'Authorization' : f'token {TOKEN}'}
-    resp = requests.get(
-            url,
-            headers=headers
-       )
+    status, languages = github.get_json(url)
 
-    if resp.status_code == 200:
-        return [r for r in resp.json().keys()]
+    if status == 200:
+        return languages
 
     else:
         return False
-   
-    
-
 
-    
 
-def get_collaborators(repo):
-    ''' Returns the contibuters' username of the repo '''
+def get_stacks(repo):
+    ''' Returns the languages used in the repo '''
+    languages = get_languages(repo)
 
-    url = f"{GIT_API_BASE_URL}/repos/{repo}/contributors"
-    headers = {'Accept': 'application/vnd.github.v3+json', 'Authorization' : f'token {TOKEN}'}
-    resp = requests.get(
-            url,
-            headers=headers
-       )
-    
-    if resp.status_code == 200:
-        contributors = [r["login"] for r in resp.json()]
-        return contributors
+    if languages is not False:
+        return [r for r in languages.keys()]
 
     else:
         return False
 
-    
 
+def language_shares(languages):
+    ''' Returns the share of the bytes of every language of a repo ({name: bytes}), from 0 to 1 '''
+    total = sum(languages.values())
+    return {name: size / total if total else 0 for name, size in languages.items()}
+
+
+@metrics.github_function
+def get_collaborators(repo, max_pages=MAX_CONTRIBUTOR_PAGES):
+    ''' Yields the contibuters' username of the repo as the pages of 100 contributors arrive, up to max_pages pages.
+        Raises GitHubError if a page can't be fetched '''
+
+    url = f"{GIT_API_BASE_URL}/repos/{repo}/contributors?per_page=100"
+    for page in github.iter_pages(url, parse=lambda body: [r["login"] for r in body], max_pages=max_pages):
+        yield from page
+
+
+def chunked(iterable, size):
+    ''' Yields lists of up to `size` items from an iterable without materializing it '''
+    iterator = iter(iterable)
+    while True:
+        chunk = list(itertools.islice(iterator, size))
+        if not chunk:
+            return
+        yield chunk
+
+
+class TTLCache:
+    ''' A size bounded, thread safe LRU cache whose entries expire.
+        Truthy and falsy values have separate lifetimes, so negative results can be kept for less time '''
+
+    def __init__(self, maxsize=1024, ttl=600, negative_ttl=60):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        ''' Returns (hit, value) '''
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return False, None
+            expires_at, value = entry
+            if time.monotonic() >= expires_at:
+                del self._entries[key]
+                return False, None
+            self._entries.move_to_end(key)
+            return True, value
+
+    def set(self, key, value):
+        with self._lock:
+            ttl = self.ttl if value else self.negative_ttl
+            self._entries[key] = (time.monotonic() + ttl, value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+
+# Results of the validators, so retried forms and edits don't wait on GitHub again
+validation_cache = TTLCache(maxsize=int(os.environ.get('GIT_VALIDATION_CACHE_SIZE', 4096)),
+                            ttl=float(os.environ.get('GIT_VALIDATION_TTL', 600)),
+                            negative_ttl=float(os.environ.get('GIT_VALIDATION_NEGATIVE_TTL', 60)))
 
+
+@metrics.github_function
 def validate_git_handle_ownership(handle, email, is_org):
     ''' The function checks if the git handle/account exists and if the account is owned by the email'''
+    key = ("owner", handle.lower(), email, is_org)
+    hit, owned = validation_cache.get(key)
+    if hit:
+        return owned
+
     url = f"{GIT_API_BASE_URL}/orgs/{handle}" if is_org else  f"{GIT_API_BASE_URL}/users/{handle}"
-    headers = {'Accept': 'application/vnd.github.v3+json', 'Authorization' : f'token {TOKEN}'}
-    resp = requests.get(
-            url,
-            headers=headers
-       )
-    if resp.status_code == 200:
-        return resp.json()["email"] == email
+    resp = github.get(url)
+    owned = resp.status_code == 200 and resp.json()["email"] == email
 
-    else:
-        return False
+    # Server errors are not an answer, so they are not cached
+    if resp.status_code < 500:
+        validation_cache.set(key, owned)
+    return owned
 
 
+@metrics.github_function
 def validate_repo_existence(repo):
     ''' The function checks if the git repo exists and is public'''
+    key = ("repo", repo.lower())
+    hit, exists = validation_cache.get(key)
+    if hit:
+        return exists
+
     url = f"{GIT_API_BASE_URL}/repos/{repo}" 
-    headers = {'Accept': 'application/vnd.github.v3+json', 'Authorization' : f'token {TOKEN}'}
-    resp = requests.get(
-            url,
-            headers=headers
-       )
-    return resp.status_code == 200
+    resp = github.get(url)
+    exists = resp.status_code == 200
+
+    if resp.status_code < 500:
+        validation_cache.set(key, exists)
+    return exists
+
+
+REPO_METADATA_FRAGMENT = '''
+fragment RepoMetadata on Repository {
+  pushedAt
+  languages(first: 100, orderBy: {field: SIZE, direction: DESC}) @include(if: $withLanguages) {
+    edges { size node { name } }
+  }
+  defaultBranchRef @include(if: $withCollaborators) {
+    target {
+      ... on Commit {
+        history(first: 100) {
+          pageInfo { hasNextPage }
+          nodes { author { user { login } } }
+        }
+      }
+    }
+  }
+}
+'''
+
+
+def build_repo_metadata_query(repos):
+    ''' Builds one GraphQL query with an aliased repository block per repo, and its variables '''
+    params = ["$withLanguages: Boolean!", "$withCollaborators: Boolean!"]
+    blocks = []
+    variables = {}
+    for i, repo in enumerate(repos):
+        owner, name = repo.split("/", 1)
+        params.append(f"$owner{i}: String!, $name{i}: String!")
+        blocks.append(f"  r{i}: repository(owner: $owner{i}, name: $name{i}) {{ ...RepoMetadata }}")
+        variables[f"owner{i}"] = owner
+        variables[f"name{i}"] = name
+
+    query = "query(" + ", ".join(params) + ") {\n" + "\n".join(blocks) + "\n}\n" + REPO_METADATA_FRAGMENT
+    return query, variables
+
+
+@metrics.github_function
+def fetch_repo_metadata(repos, languages=True, collaborators=True):
+    ''' Returns {repo: metadata} for a batch of repos, fetched with a single GraphQL query.
+        The metadata holds "pushed_at", "languages" ({name: bytes}) and "collaborators" (logins of the commit authors),
+        or is None if the repo doesn't exist. GraphQL has no contributors list, so the commit authors of the default
+        branch stand in for it. When a repo has more than one page of history, or the GraphQL call fails,
+        the REST endpoints are used instead. "collaborators" is False if they couldn't be fetched '''
+    repos = list(repos)
+    query, variables = build_repo_metadata_query(repos)
+    variables.update(withLanguages=languages, withCollaborators=collaborators)
+
+    resp = github.post(f"{GIT_API_BASE_URL}/graphql", json={"query": query, "variables": variables}, resource="graphql")
+    data = resp.json().get("data") if resp.status_code == 200 else None
+    if data is None:
+        logger.warning("GraphQL metadata query failed with %s, falling back to REST for %d repos", resp.status_code, len(repos))
+        return {repo: fetch_repo_metadata_rest(repo, languages, collaborators) for repo in repos}
+
+    metadata = {}
+    for i, repo in enumerate(repos):
+        node = data.get(f"r{i}")
+        if node is None:
+            metadata[repo] = None
+            continue
+
+        meta = {"pushed_at": node.get("pushedAt")}
+        if languages:
+            meta["languages"] = {edge["node"]["name"]: edge["size"] for edge in node["languages"]["edges"]}
+        if collaborators:
+            history = ((node.get("defaultBranchRef") or {}).get("target") or {}).get("history")
+            if history and not history["pageInfo"]["hasNextPage"]:
+                logins = [n["author"]["user"]["login"] for n in history["nodes"] if n["author"] and n["author"]["user"]]
+                meta["collaborators"] = list(dict.fromkeys(logins))
+            elif history is None:
+                # Empty repositories have no default branch
+                meta["collaborators"] = []
+            else:
+                meta["collaborators"] = rest_collaborators(repo)
+        metadata[repo] = meta
+
+    return metadata
+
+
+def rest_collaborators(repo):
+    ''' The full contributors list of a repo from REST, or False if it couldn't be fetched '''
+    try:
+        return list(get_collaborators(repo))
+    except GitHubError:
+        return False
+
+
+@metrics.github_function
+def fetch_repo_metadata_rest(repo, languages=True, collaborators=True):
+    ''' The REST version of the metadata fetched by fetch_repo_metadata, for one repo '''
+    meta = {"pushed_at": None}
+    if languages:
+        meta["languages"] = get_languages(repo)
+        if meta["languages"] is False:
+            return None
+    if collaborators:
+        meta["collaborators"] = rest_collaborators(repo)
+    return meta
+
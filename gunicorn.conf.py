@@ -0,0 +1,9 @@
+''' Loaded by gunicorn from the working directory '''
+import os
+from prometheus_client import multiprocess
+
+
+def child_exit(server, worker):
+    ''' Drops the live gauges of a dead worker from the aggregate of /metrics '''
+    if os.environ.get('PROMETHEUS_MULTIPROC_DIR'):
+        multiprocess.mark_process_dead(worker.pid)
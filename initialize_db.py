@@ -1,7 +1,10 @@
 from models import db, connect_db
 from app import app
+from migrations import migrate
 
 connect_db(app)
 
 db.drop_all()
-db.create_all()
\ No newline at end of file
+db.create_all()
+# The tables are up to date, so this only records the migrations as applied
+migrate()
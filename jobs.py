@@ -0,0 +1,88 @@
+import logging
+import os
+import traceback
+from datetime import datetime, timedelta
+from models import db, Job
+import metrics
+
+logger = logging.getLogger(__name__)
+
+MAX_ATTEMPTS = int(os.environ.get('JOB_MAX_ATTEMPTS', 5))
+RETRY_DELAY = timedelta(seconds=int(os.environ.get('JOB_RETRY_DELAY_SECONDS', 30)))
+BATCH_SIZE = int(os.environ.get('JOB_BATCH_SIZE', 20))
+
+# A running job whose worker hasn't finished it within this time is considered lost and is run again
+JOB_TIMEOUT = timedelta(minutes=int(os.environ.get('JOB_TIMEOUT_MINUTES', 15)))
+
+# {kind: (handler, on_give_up)}
+HANDLERS = {}
+
+
+def job_handler(kind, on_give_up=None):
+    ''' Registers the decorated function as the handler of the jobs of a kind. It is called with the job's payload as
+        keyword arguments and the job is retried if it raises. `on_give_up` is called with the payload after the last attempt '''
+    def register(handler):
+        HANDLERS[kind] = (handler, on_give_up)
+        return handler
+    return register
+
+
+def enqueue(kind, payload, key=None, delay=None):
+    ''' Adds a job to the caller's session, so it is committed with the change that needs it.
+        Nothing is added if a job with the same key is already waiting to run '''
+    if key and Job.query.filter_by(key=key, status="queued").first():
+        return None
+    job = Job(kind=kind, payload=payload, key=key, run_after=datetime.utcnow() + (delay or timedelta()))
+    db.session.add(job)
+    return job
+
+
+def claim_jobs(limit=BATCH_SIZE):
+    ''' Marks up to `limit` due jobs as running and returns them. SKIP LOCKED lets several workers claim jobs at once '''
+    now = datetime.utcnow()
+    jobs = (Job.query
+            .filter(((Job.status == "queued") & (Job.run_after <= now)) |
+                    ((Job.status == "running") & (Job.locked_at < now - JOB_TIMEOUT)))
+            .order_by(Job.run_after)
+            .limit(limit)
+            .with_for_update(skip_locked=True)
+            .all())
+    for job in jobs:
+        job.status = "running"
+        job.attempts += 1
+        job.locked_at = now
+    db.session.commit()
+    return jobs
+
+
+def run_job(job):
+    ''' Runs a claimed job and records the outcome. Failed jobs are retried with an exponential backoff '''
+    handler, on_give_up = HANDLERS[job.kind]
+    try:
+        with metrics.job_timer(job.kind):
+            handler(**job.payload)
+    except Exception:
+        db.session.rollback()
+        job.last_error = traceback.format_exc()
+        if job.attempts >= MAX_ATTEMPTS:
+            logger.error("Job %s (%s) failed for good after %d attempts", job.id, job.kind, job.attempts)
+            job.status = "failed"
+            if on_give_up:
+                on_give_up(**job.payload)
+        else:
+            logger.warning("Job %s (%s) failed, retrying", job.id, job.kind)
+            job.status = "queued"
+            job.run_after = datetime.utcnow() + RETRY_DELAY * 2 ** (job.attempts - 1)
+    else:
+        job.status = "done"
+        job.last_error = None
+    job.locked_at = None
+    db.session.commit()
+
+
+def run_pending_jobs(limit=BATCH_SIZE):
+    ''' Runs the jobs that are due and returns how many were run '''
+    jobs = claim_jobs(limit)
+    for job in jobs:
+        run_job(job)
+    return len(jobs)
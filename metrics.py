@@ -0,0 +1,114 @@
+''' Prometheus metrics of the routes, the GitHub calls and the scheduled jobs, served at /metrics.
+
+Under gunicorn, set PROMETHEUS_MULTIPROC_DIR to an empty directory shared by the workers (and the clock process) so
+/metrics aggregates the samples of all the processes. Without it, /metrics shows the samples of the serving process.
+'''
+import functools
+import inspect
+import os
+import threading
+import time
+from contextlib import contextmanager
+from flask import g, request
+from prometheus_client import (CollectorRegistry, Counter, Gauge, Histogram, REGISTRY, CONTENT_TYPE_LATEST,
+                               generate_latest, multiprocess)
+
+MULTIPROCESS = bool(os.environ.get('PROMETHEUS_MULTIPROC_DIR'))
+
+REQUEST_LATENCY = Histogram("colab_http_request_duration_seconds", "Latency of the requests per endpoint",
+                            ["endpoint", "method", "status"])
+
+GITHUB_REQUESTS = Counter("colab_github_requests_total", "GitHub API calls per git.py function and status code",
+                          ["function", "status"])
+GITHUB_LATENCY = Histogram("colab_github_request_duration_seconds", "Latency of the GitHub API calls per git.py function",
+                           ["function"])
+GITHUB_RATE_LIMIT_REMAINING = Gauge("colab_github_rate_limit_remaining", "Remaining GitHub rate limit per resource",
+                                    ["resource"], multiprocess_mode="liveall")
+
+JOB_DURATION = Histogram("colab_job_duration_seconds", "Duration of the scheduled and queued jobs", ["job"],
+                         buckets=(0.1, 0.5, 1, 5, 10, 30, 60, 120, 300, 600, float("inf")))
+JOB_PROJECTS = Counter("colab_job_projects_total", "Projects processed by the jobs", ["job"])
+JOB_ROWS = Counter("colab_job_rows_total", "Rows written by the jobs", ["job", "table", "operation"])
+
+# The git.py function and the job running in the current thread
+_context = threading.local()
+
+
+def connect_metrics(app):
+    ''' Times the requests of the app '''
+
+    @app.before_request
+    def start_timer():
+        g.request_started = time.perf_counter()
+
+    @app.after_request
+    def observe_request(response):
+        if "request_started" in g:
+            REQUEST_LATENCY.labels(request.endpoint or "unknown", request.method, response.status_code).observe(
+                time.perf_counter() - g.request_started)
+        return response
+
+
+def render():
+    ''' Returns the body and content type of the /metrics response '''
+    if MULTIPROCESS:
+        registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+    else:
+        registry = REGISTRY
+    return generate_latest(registry), CONTENT_TYPE_LATEST
+
+
+@contextmanager
+def _labelled(name, value):
+    previous = getattr(_context, name, None)
+    setattr(_context, name, value)
+    try:
+        yield
+    finally:
+        setattr(_context, name, previous)
+
+
+def github_function(func):
+    ''' Labels the GitHub calls made by the decorated git.py function with its name '''
+    if inspect.isgeneratorfunction(func):
+        @functools.wraps(func)
+        def generator(*args, **kwargs):
+            with _labelled("github_function", func.__name__):
+                yield from func(*args, **kwargs)
+        return generator
+
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        with _labelled("github_function", func.__name__):
+            return func(*args, **kwargs)
+    return wrapper
+
+
+def observe_github_call(resp, resource, elapsed):
+    function = getattr(_context, "github_function", None) or "other"
+    GITHUB_REQUESTS.labels(function, resp.status_code).inc()
+    GITHUB_LATENCY.labels(function).observe(elapsed)
+    remaining = resp.headers.get("X-RateLimit-Remaining")
+    if remaining is not None:
+        GITHUB_RATE_LIMIT_REMAINING.labels(resp.headers.get("X-RateLimit-Resource", resource)).set(int(remaining))
+
+
+@contextmanager
+def job_timer(job):
+    ''' Times a job run. The projects and rows counted in the block are labelled with the job '''
+    start = time.perf_counter()
+    with _labelled("job", job):
+        try:
+            yield
+        finally:
+            JOB_DURATION.labels(job).observe(time.perf_counter() - start)
+
+
+def count_projects(count):
+    JOB_PROJECTS.labels(getattr(_context, "job", None) or "other").inc(count)
+
+
+def count_rows(table, operation, count):
+    if count:
+        JOB_ROWS.labels(getattr(_context, "job", None) or "other", table, operation).inc(count)
@@ -0,0 +1,221 @@
+''' Versioned schema migrations.
+
+A migration is a function that brings the schema of a database made from an earlier models.py up to date without
+losing its data. `migrate()` applies the migrations a database hasn't had yet, in order, each in its own transaction
+together with the schema_migrations row that records it. Every migration is a no-op on a schema that already has its
+change, so a database made by db.create_all() from the current models migrates cleanly too.
+
+    python migrations.py            applies the pending migrations
+    python migrations.py --list     lists the migrations and whether they were applied
+
+When a model changes, add a migration with the next version that makes the same change in SQL.
+'''
+import argparse
+import logging
+from sqlalchemy import func, select, text
+from models import db, SchemaMigration
+from schedule import advisory_lock_key
+
+logger = logging.getLogger(__name__)
+
+# [(version, name, function)] in version order
+MIGRATIONS = []
+
+
+def migration(version):
+    ''' Registers the decorated function as the migration of a version. It is called with the connection to migrate '''
+    def register(func):
+        assert not MIGRATIONS or version > MIGRATIONS[-1][0], "migrations are declared in version order"
+        MIGRATIONS.append((version, func.__name__, func))
+        return func
+    return register
+
+
+def applied_versions(conn):
+    with conn.begin():
+        SchemaMigration.__table__.create(conn, checkfirst=True)
+    return {version for (version,) in conn.execute(select(SchemaMigration.version))}
+
+
+def migrate():
+    ''' Applies the pending migrations and returns their versions. An advisory lock keeps two processes (a release
+        phase and a deploy script, say) from migrating at once '''
+    key = advisory_lock_key("migrations")
+    applied = []
+    with db.engine.connect() as conn:
+        conn.execute(select(func.pg_advisory_lock(key)))
+        try:
+            done = applied_versions(conn)
+            for version, name, apply in MIGRATIONS:
+                if version in done:
+                    continue
+                with conn.begin():
+                    apply(conn)
+                    conn.execute(db.insert(SchemaMigration).values(version=version, name=name))
+                logger.info("Applied migration %s %s", version, name)
+                applied.append(version)
+        finally:
+            conn.execute(select(func.pg_advisory_unlock(key)))
+    return applied
+
+
+def execute(conn, *statements):
+    for statement in statements:
+        conn.execute(text(statement))
+
+
+def remove_duplicates(conn, table, columns):
+    ''' Deletes the rows of a table that repeat the columns of another row, keeping the latest (highest id) one '''
+    same = " AND ".join(f"older.{column} = newer.{column}" for column in columns)
+    result = conn.execute(text(f"DELETE FROM {table} older USING {table} newer WHERE {same} AND older.id < newer.id"))
+    if result.rowcount:
+        logger.info("Removed %d duplicate rows from %s", result.rowcount, table)
+
+
+def add_unique_constraint(conn, table, name, columns):
+    exists = conn.execute(text("SELECT 1 FROM pg_constraint WHERE conname = :name"), {"name": name}).first()
+    if not exists:
+        remove_duplicates(conn, table, columns)
+        execute(conn, f"ALTER TABLE {table} ADD CONSTRAINT {name} UNIQUE ({', '.join(columns)})")
+
+
+@migration(1)
+def sync_and_cache_tables(conn):
+    ''' The tables and columns of the GitHub cache, the job queue and the sync jobs, added to models.py without a migration '''
+    execute(conn,
+            "ALTER TABLE projects ADD COLUMN IF NOT EXISTS last_synced_at TIMESTAMP WITHOUT TIME ZONE",
+            "ALTER TABLE projects ADD COLUMN IF NOT EXISTS pushed_at TIMESTAMP WITHOUT TIME ZONE",
+            "ALTER TABLE projects ADD COLUMN IF NOT EXISTS sync_failures INTEGER NOT NULL DEFAULT 0",
+            "ALTER TABLE projects ALTER COLUMN sync_failures DROP DEFAULT",
+            # Existing projects are due at once
+            "ALTER TABLE projects ADD COLUMN IF NOT EXISTS next_sync_at TIMESTAMP WITHOUT TIME ZONE NOT NULL DEFAULT now()",
+            "ALTER TABLE projects ALTER COLUMN next_sync_at DROP DEFAULT",
+            "ALTER TABLE projects ADD COLUMN IF NOT EXISTS sync_status VARCHAR(10) NOT NULL DEFAULT 'synced'",
+            "ALTER TABLE projects ALTER COLUMN sync_status DROP DEFAULT",
+            "ALTER TABLE projects ADD COLUMN IF NOT EXISTS primary_stack_id INTEGER REFERENCES stacks (id) ON DELETE SET NULL",
+            "CREATE INDEX IF NOT EXISTS ix_projects_next_sync_at ON projects (next_sync_at)",
+            "CREATE INDEX IF NOT EXISTS ix_projects_primary_stack_id ON projects (primary_stack_id)",
+
+            "ALTER TABLE project_stacks ADD COLUMN IF NOT EXISTS share FLOAT",
+            "CREATE INDEX IF NOT EXISTS ix_project_stacks_stack_id_share ON project_stacks (stack_id, share)",
+
+            """CREATE TABLE IF NOT EXISTS project_contributors (
+                id SERIAL NOT NULL,
+                project_id INTEGER NOT NULL,
+                login VARCHAR(50) NOT NULL,
+                PRIMARY KEY (id),
+                UNIQUE (project_id, login),
+                FOREIGN KEY (project_id) REFERENCES projects (id) ON DELETE CASCADE
+            )""",
+            "CREATE INDEX IF NOT EXISTS ix_project_contributors_login ON project_contributors (login)",
+
+            """CREATE TABLE IF NOT EXISTS git_response_cache (
+                url VARCHAR NOT NULL,
+                etag VARCHAR,
+                last_modified VARCHAR,
+                payload JSON NOT NULL,
+                next_url VARCHAR,
+                fetched_at TIMESTAMP WITHOUT TIME ZONE NOT NULL,
+                PRIMARY KEY (url)
+            )""",
+
+            """CREATE TABLE IF NOT EXISTS jobs (
+                id SERIAL NOT NULL,
+                kind VARCHAR(50) NOT NULL,
+                key VARCHAR,
+                payload JSON NOT NULL,
+                status VARCHAR(10) NOT NULL,
+                attempts INTEGER NOT NULL,
+                last_error TEXT,
+                run_after TIMESTAMP WITHOUT TIME ZONE NOT NULL,
+                locked_at TIMESTAMP WITHOUT TIME ZONE,
+                created_at TIMESTAMP WITHOUT TIME ZONE NOT NULL,
+                PRIMARY KEY (id)
+            )""",
+            "CREATE INDEX IF NOT EXISTS ix_jobs_key ON jobs (key)",
+            "CREATE INDEX IF NOT EXISTS ix_jobs_status_run_after ON jobs (status, run_after)",
+
+            """CREATE TABLE IF NOT EXISTS reference_versions (
+                name VARCHAR(20) NOT NULL,
+                version INTEGER NOT NULL,
+                PRIMARY KEY (name)
+            )""")
+
+
+@migration(2)
+def foreign_key_indexes_and_unique_links(conn):
+    ''' Indexes the foreign keys that the routes and the jobs filter on, and makes each link of the join tables unique.
+        The duplicate links are removed first, keeping the latest of each '''
+    execute(conn,
+            "CREATE INDEX IF NOT EXISTS ix_projects_owned_by ON projects (owned_by)",
+            "CREATE INDEX IF NOT EXISTS ix_projects_sector_id ON projects (sector_id)",
+            "CREATE INDEX IF NOT EXISTS ix_collaborations_username ON collaborations (username)",
+            "CREATE INDEX IF NOT EXISTS ix_user_preferences_sectors_sector_id ON user_preferences_sectors (sector_id)",
+            "CREATE INDEX IF NOT EXISTS ix_user_preferences_stacks_stack_id ON user_preferences_stacks (stack_id)")
+
+    # The unique constraints' indexes lead with the columns these indexes covered
+    add_unique_constraint(conn, "project_stacks", "uq_project_stacks_project_id_stack_id", ["project_id", "stack_id"])
+    add_unique_constraint(conn, "collaborations", "uq_collaborations_project_id_username", ["project_id", "username"])
+    add_unique_constraint(conn, "user_preferences_sectors", "uq_user_preferences_sectors_username_sector_id", ["username", "sector_id"])
+    add_unique_constraint(conn, "user_preferences_stacks", "uq_user_preferences_stacks_username_stack_id", ["username", "stack_id"])
+    execute(conn,
+            "DROP INDEX IF EXISTS ix_project_stacks_project_id_stack_id",
+            "DROP INDEX IF EXISTS ix_user_preferences_sectors_username",
+            "DROP INDEX IF EXISTS ix_user_preferences_stacks_username")
+
+
+@migration(3)
+def user_project_matches(conn):
+    ''' The preference scores of the preferred only view, computed for every user and project '''
+    execute(conn,
+            """CREATE TABLE IF NOT EXISTS user_project_matches (
+                username VARCHAR(20) NOT NULL,
+                project_id INTEGER NOT NULL,
+                score INTEGER NOT NULL,
+                PRIMARY KEY (username, project_id),
+                FOREIGN KEY (username) REFERENCES users (username) ON DELETE CASCADE,
+                FOREIGN KEY (project_id) REFERENCES projects (id) ON DELETE CASCADE
+            )""",
+            "CREATE INDEX IF NOT EXISTS ix_user_project_matches_username_score ON user_project_matches (username, score DESC NULLS LAST, project_id)",
+            "CREATE INDEX IF NOT EXISTS ix_user_project_matches_project_id ON user_project_matches (project_id)",
+            """INSERT INTO user_project_matches (username, project_id, score)
+               SELECT username, project_id, count(*) FROM (
+                   SELECT p.username, ps.project_id FROM user_preferences_stacks p JOIN project_stacks ps ON ps.stack_id = p.stack_id
+                   UNION ALL
+                   SELECT p.username, projects.id FROM user_preferences_sectors p JOIN projects ON projects.sector_id = p.sector_id
+               ) points GROUP BY username, project_id
+               ON CONFLICT (username, project_id) DO UPDATE SET score = excluded.score""")
+
+
+@migration(4)
+def project_search_vector(conn):
+    ''' The full text search of /projects: a weighted search vector of the title and description, generated by
+        Postgres, and its GIN index. Adding the column rewrites the projects table '''
+    execute(conn,
+            """ALTER TABLE projects ADD COLUMN IF NOT EXISTS search_vector TSVECTOR GENERATED ALWAYS AS (
+                setweight(to_tsvector('english', coalesce(title, '')), 'A') ||
+                setweight(to_tsvector('english', coalesce(description, '')), 'B')) STORED""",
+            "CREATE INDEX IF NOT EXISTS ix_projects_search_vector ON projects USING gin (search_vector)")
+
+
+def main():
+    from app import app
+
+    parser = argparse.ArgumentParser(description="Apply the pending schema migrations")
+    parser.add_argument("--list", action="store_true", help="List the migrations and whether they were applied")
+    args = parser.parse_args()
+
+    with app.app_context():
+        if args.list:
+            with db.engine.connect() as conn:
+                done = applied_versions(conn)
+            for version, name, _ in MIGRATIONS:
+                print(f"{version:>4} {name} {'applied' if version in done else 'pending'}")
+            return
+        applied = migrate()
+        print(f"Applied {len(applied)} migrations" + (f": {', '.join(map(str, applied))}" if applied else ""))
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    main()
@@ -1,5 +1,6 @@
 from flask_sqlalchemy import SQLAlchemy
 from flask_bcrypt import Bcrypt
+from sqlalchemy.dialects.postgresql import insert, TSVECTOR
 from datetime import datetime
 
 bcrypt = Bcrypt()
@@ -84,10 +85,18 @@ class User(db.Model):
         else:
             return False
 
+    def backfill_collaborations(self):
+        ''' Links the user to the projects whose repositories list their handle among the contributors fetched so far '''
+        contributed = (db.session.query(ProjectContributor.project_id, db.literal(self.username))
+                       .filter(ProjectContributor.login == self.git_handle))
+        stmt = insert(Collaboration).from_select(["project_id", "username"], contributed)
+        db.session.execute(stmt.on_conflict_do_nothing(index_elements=["project_id", "username"]))
+
 
 
 class Collaboration(db.Model):
     __tablename__ = "collaborations"
+    __table_args__ = (db.UniqueConstraint("project_id", "username", name="uq_collaborations_project_id_username"),)
 
 
     id = db.Column(db.Integer,
@@ -100,12 +109,39 @@ class Collaboration(db.Model):
 
     username = db.Column( db.String(20),
                     db.ForeignKey('users.username', ondelete="CASCADE"),
+                      nullable=False,
+                      index=True)
+
+
+
+class ProjectContributor(db.Model):
+    """ A contributor login of a project's repository, as last fetched from GitHub, whether or not it is a user """
+    __tablename__ = "project_contributors"
+    __table_args__ = (db.UniqueConstraint("project_id", "login"),)
+
+
+    id = db.Column(db.Integer,
+                   primary_key=True,
+                   autoincrement=True)
+
+    project_id = db.Column( db.Integer,
+                    db.ForeignKey('projects.id', ondelete="CASCADE"),
                       nullable=False)
 
+    login = db.Column(db.String(50),
+                     nullable=False,
+                     index=True)
+
+
+
+# The words of a project's title, weighted above those of its description, as searched by /projects
+PROJECT_SEARCH_DOCUMENT = ("setweight(to_tsvector('english', coalesce(title, '')), 'A') || "
+                           "setweight(to_tsvector('english', coalesce(description, '')), 'B')")
 
 
 class Project(db.Model):
     __tablename__ = "projects"
+    __table_args__ = (db.Index("ix_projects_search_vector", "search_vector", postgresql_using="gin"),)
 
 
     id = db.Column(db.Integer,
@@ -128,13 +164,46 @@ class Project(db.Model):
 
     owned_by = db.Column( db.String(20),
                     db.ForeignKey('users.username', ondelete="CASCADE"),
-                      nullable=False)
+                      nullable=False,
+                      index=True)
     sector_id = db.Column( db.Integer,
                     db.ForeignKey('sectors.id', ondelete="CASCADE"),
-                      nullable=False)
+                      nullable=False,
+                      index=True)
+
+    # Sync bookkeeping of the scheduler: when the project was last refreshed, when the repository was last pushed to,
+    # the number of refreshes that failed in a row and when the project is due again
+    last_synced_at = db.Column(db.DateTime)
+
+    pushed_at = db.Column(db.DateTime)
+
+    sync_failures = db.Column(db.Integer,
+                     nullable=False,
+                     default=0)
+
+    next_sync_at = db.Column(db.DateTime,
+                     nullable=False,
+                     default=datetime.utcnow,
+                     index=True)
+
+    # "syncing" while the stacks and collaborators are being fetched, "synced" once done, "failed" if they couldn't be
+    sync_status = db.Column(db.String(10),
+                     nullable=False,
+                     default="synced")
+
+    # The language with the most bytes in the repository
+    primary_stack_id = db.Column(db.Integer,
+                     db.ForeignKey('stacks.id', ondelete="SET NULL"),
+                     index=True)
+
+    # Kept up to date by Postgres from the title and description. Only loaded when asked for
+    search_vector = db.deferred(db.Column(TSVECTOR,
+                     db.Computed(PROJECT_SEARCH_DOCUMENT, persisted=True)))
 
     sector = db.relationship("Sector", backref='projects')
 
+    primary_stack = db.relationship("Stack")
+
 
     stacks = db.relationship(
         'Stack',
@@ -175,6 +244,9 @@ class Sector(db.Model):
 
 class ProjectStack(db.Model):
     __tablename__ = "project_stacks"
+    # Serve the stack filter of /projects, ranked by share, and the stacks of a project
+    __table_args__ = (db.Index("ix_project_stacks_stack_id_share", "stack_id", "share"),
+                      db.UniqueConstraint("project_id", "stack_id", name="uq_project_stacks_project_id_stack_id"))
 
 
     id = db.Column(db.Integer,
@@ -189,9 +261,13 @@ class ProjectStack(db.Model):
                     db.ForeignKey('stacks.id', ondelete="CASCADE"),
                       nullable=False)  
 
+    # Share of the repository's bytes in the stack's language, from 0 to 1. None if it wasn't fetched yet
+    share = db.Column(db.Float)
+
 
 class UserPreferenceSector(db.Model):
     __tablename__ = "user_preferences_sectors"
+    __table_args__ = (db.UniqueConstraint("username", "sector_id", name="uq_user_preferences_sectors_username_sector_id"),)
 
 
     id = db.Column(db.Integer,
@@ -204,11 +280,13 @@ class UserPreferenceSector(db.Model):
     
     sector_id = db.Column( db.Integer,
                     db.ForeignKey('sectors.id', ondelete="CASCADE"),
-                      nullable=False)
+                      nullable=False,
+                      index=True)
 
 
 class UserPreferenceStack(db.Model):
     __tablename__ = "user_preferences_stacks"
+    __table_args__ = (db.UniqueConstraint("username", "stack_id", name="uq_user_preferences_stacks_username_stack_id"),)
 
 
     id = db.Column(db.Integer,
@@ -221,5 +299,148 @@ class UserPreferenceStack(db.Model):
     
     stack_id = db.Column( db.Integer,
                     db.ForeignKey('stacks.id', ondelete="CASCADE"),
-                      nullable=False)
+                      nullable=False,
+                      index=True)
+
+
+class UserProjectMatch(db.Model):
+    """ How well a project matches a user's preferences: a point for each of its stacks the user prefers, and one if
+        the user prefers its sector. Only the pairs that match have a row. Serves the preferred only view of /projects """
+    __tablename__ = "user_project_matches"
+    # Best matches of a user first, in the order of the page_projects keyset
+    __table_args__ = (db.Index("ix_user_project_matches_username_score", "username", db.text("score DESC NULLS LAST"), "project_id"),)
+
+
+    username = db.Column( db.String(20),
+                    db.ForeignKey('users.username', ondelete="CASCADE"),
+                      primary_key=True)
+
+    project_id = db.Column( db.Integer,
+                    db.ForeignKey('projects.id', ondelete="CASCADE"),
+                      primary_key=True,
+                      index=True)
+
+    score = db.Column(db.Integer,
+                     nullable=False)
+
+
+    @classmethod
+    def refresh(cls, usernames=None, project_ids=None):
+        ''' Recomputes the matches of the users, or of the projects, or else of everyone, with one delete and one
+            insert. Called when preferences, a project's sector or a project's stacks change. The caller commits '''
+        db.session.flush()
+        stack_points = db.select(UserPreferenceStack.username, ProjectStack.project_id).join_from(
+            UserPreferenceStack, ProjectStack, ProjectStack.stack_id == UserPreferenceStack.stack_id)
+        sector_points = db.select(UserPreferenceSector.username, Project.id.label("project_id")).join_from(
+            UserPreferenceSector, Project, Project.sector_id == UserPreferenceSector.sector_id)
+        stale = cls.__table__.delete()
+        if usernames is not None:
+            stack_points = stack_points.where(UserPreferenceStack.username.in_(usernames))
+            sector_points = sector_points.where(UserPreferenceSector.username.in_(usernames))
+            stale = stale.where(cls.username.in_(usernames))
+        if project_ids is not None:
+            stack_points = stack_points.where(ProjectStack.project_id.in_(project_ids))
+            sector_points = sector_points.where(Project.id.in_(project_ids))
+            stale = stale.where(cls.project_id.in_(project_ids))
+
+        points = db.union_all(stack_points, sector_points).subquery()
+        scores = (db.select(points.c.username, points.c.project_id, db.func.count())
+                  .group_by(points.c.username, points.c.project_id))
+        db.session.execute(stale)
+        # A concurrent refresh of the same pairs may have inserted them since the delete
+        stmt = insert(cls).from_select(["username", "project_id", "score"], scores)
+        db.session.execute(stmt.on_conflict_do_update(index_elements=["username", "project_id"], set_={"score": stmt.excluded.score}))
+
+
+class GitResponseCache(db.Model):
+    """ Validators (ETag / Last-Modified) and the parsed body of GitHub responses, keyed by URL """
+    __tablename__ = "git_response_cache"
+
+
+    url = db.Column(db.String,
+                   primary_key=True)
+
+    etag = db.Column(db.String)
+
+    last_modified = db.Column(db.String)
+
+    payload = db.Column(db.JSON,
+                     nullable=False)
+
+    next_url = db.Column(db.String)
+
+    fetched_at = db.Column(db.DateTime,
+                     nullable=False,
+                     default=datetime.utcnow)
+
+
+class Job(db.Model):
+    """ A task of the durable job queue, run by the worker in the scheduler process """
+    __tablename__ = "jobs"
+    __table_args__ = (db.Index("ix_jobs_status_run_after", "status", "run_after"),)
+
+
+    id = db.Column(db.Integer,
+                   primary_key=True,
+                   autoincrement=True)
+
+    kind = db.Column(db.String(50),
+                     nullable=False)
+
+    # Jobs with the same key are not queued twice
+    key = db.Column(db.String,
+                     index=True)
+
+    payload = db.Column(db.JSON,
+                     nullable=False)
+
+    # queued, running, done or failed
+    status = db.Column(db.String(10),
+                     nullable=False,
+                     default="queued")
 
+    attempts = db.Column(db.Integer,
+                     nullable=False,
+                     default=0)
+
+    last_error = db.Column(db.Text)
+
+    run_after = db.Column(db.DateTime,
+                     nullable=False,
+                     default=datetime.utcnow)
+
+    locked_at = db.Column(db.DateTime)
+
+    created_at = db.Column(db.DateTime,
+                     nullable=False,
+                     default=datetime.utcnow)
+
+
+class ReferenceVersion(db.Model):
+    """ A version stamp of cached reference data, bumped when the data changes (see reference.py) """
+    __tablename__ = "reference_versions"
+
+
+    name = db.Column(db.String(20),
+                     primary_key=True)
+
+    version = db.Column(db.Integer,
+                     nullable=False,
+                     default=0)
+
+
+class SchemaMigration(db.Model):
+    """ A migration of migrations.py that was applied to the database """
+    __tablename__ = "schema_migrations"
+
+
+    version = db.Column(db.Integer,
+                     primary_key=True,
+                     autoincrement=False)
+
+    name = db.Column(db.String(100),
+                     nullable=False)
+
+    applied_at = db.Column(db.DateTime,
+                     nullable=False,
+                     default=datetime.utcnow)
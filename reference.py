@@ -0,0 +1,80 @@
+''' A process-level cache of the sectors and stacks, the reference data behind the filter and project forms.
+
+Sessions that insert, update or delete a Sector or a Stack bump a version stamp in the reference_versions table in
+the same transaction. Every process compares its copy with the stamp at most every REFERENCE_CHECK_SECONDS and
+reloads it when it is stale, so all the gunicorn workers see a change within that time. The process that made the
+change reloads on its next read.
+'''
+import os
+import threading
+import time
+from sqlalchemy import event
+from sqlalchemy.dialects.postgresql import insert
+from sqlalchemy.orm import Session
+from models import db, Sector, Stack, ReferenceVersion
+
+# Seconds between two checks of the version stamp
+CHECK_SECONDS = float(os.environ.get('REFERENCE_CHECK_SECONDS', 10))
+
+VERSION_NAME = "reference"
+
+
+class ReferenceData:
+    ''' The sectors and stacks as (id, name) choices and id -> name maps '''
+
+    def __init__(self, check_seconds=CHECK_SECONDS):
+        self.check_seconds = check_seconds
+        self.version = None
+        self.checked_at = 0
+        self.sector_choices = []
+        self.stack_choices = []
+        self.sector_names = {}
+        self.stack_names = {}
+        self._lock = threading.Lock()
+
+    def refresh(self):
+        ''' Reloads the data if it was invalidated, or if the version stamp moved since the last check '''
+        if self.version is not None and time.monotonic() - self.checked_at < self.check_seconds:
+            return self
+        with self._lock:
+            stamp = db.session.query(ReferenceVersion.version).filter_by(name=VERSION_NAME).scalar() or 0
+            if stamp != self.version:
+                sector_choices = [(s.id, s.name) for s in Sector.query.order_by(Sector.id)]
+                stack_choices = [(s.id, s.name) for s in Stack.query.order_by(Stack.id)]
+                self.sector_choices, self.stack_choices = sector_choices, stack_choices
+                self.sector_names, self.stack_names = dict(sector_choices), dict(stack_choices)
+                self.version = stamp
+            self.checked_at = time.monotonic()
+        return self
+
+    def invalidate(self):
+        self.version = None
+
+    def bump(self, session):
+        ''' Moves the version stamp in the session's transaction. Called for the changes the ORM events can't see '''
+        stmt = insert(ReferenceVersion).values(name=VERSION_NAME, version=1)
+        stmt = stmt.on_conflict_do_update(index_elements=[ReferenceVersion.name], set_={"version": ReferenceVersion.version + 1})
+        session.connection().execute(stmt)
+        session.info["reference_changed"] = True
+
+
+reference_data = ReferenceData()
+
+
+@event.listens_for(Session, "after_flush")
+def bump_on_change(session, flush_context):
+    changed = list(session.new) + list(session.deleted) + [obj for obj in session.dirty
+                                                          if session.is_modified(obj, include_collections=False)]
+    if any(isinstance(obj, (Sector, Stack)) for obj in changed):
+        reference_data.bump(session)
+
+
+@event.listens_for(Session, "after_commit")
+def invalidate_on_commit(session):
+    if session.info.pop("reference_changed", False):
+        reference_data.invalidate()
+
+
+@event.listens_for(Session, "after_rollback")
+def forget_change(session):
+    session.info.pop("reference_changed", None)
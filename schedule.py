@@ -1,7 +1,39 @@
+import functools
+import logging
+import os
+import requests
+import threading
+import zlib
+from concurrent.futures import ThreadPoolExecutor
 from flask_apscheduler import APScheduler
-from git import get_stacks, get_collaborators
-from models import db, connect_db, User, Stack, Collaboration, Project
-from datetime import datetime
+from git import fetch_repo_metadata, language_shares, github, chunked, BACKGROUND, GRAPHQL_BATCH_SIZE, GitHubError, RateLimitExceeded
+from models import db, connect_db, User, Stack, Collaboration, Project, ProjectStack, ProjectContributor, UserProjectMatch
+from sqlalchemy import func, select
+from sqlalchemy.dialects.postgresql import insert
+from jobs import job_handler, enqueue, run_pending_jobs
+import metrics
+from reference import reference_data
+from datetime import datetime, timedelta
+
+logger = logging.getLogger(__name__)
+
+# Number of repositories fetched from GitHub in parallel by the refresh jobs
+FETCH_CONCURRENCY = int(os.environ.get('GIT_FETCH_CONCURRENCY', 8))
+
+# Seconds between two polls of the job queue by the worker
+JOB_POLL_SECONDS = int(os.environ.get('JOB_POLL_SECONDS', 5))
+
+# A project is refreshed again after MIN_SYNC_INTERVAL if its repository was pushed to since the last refresh.
+# Otherwise the interval doubles on every refresh, up to MAX_SYNC_INTERVAL. Failing refreshes back off the same way.
+MIN_SYNC_INTERVAL = timedelta(hours=float(os.environ.get('SYNC_MIN_INTERVAL_HOURS', 1)))
+MAX_SYNC_INTERVAL = timedelta(hours=float(os.environ.get('SYNC_MAX_INTERVAL_HOURS', 24 * 7)))
+
+# Projects refreshed per tick of refresh_due_projects, and minutes between ticks
+SYNC_BUDGET = int(os.environ.get('SYNC_BUDGET_PER_TICK', 500))
+SYNC_TICK_MINUTES = int(os.environ.get('SYNC_TICK_MINUTES', 10))
+
+# Projects whose collaborator changes are written and committed together
+SYNC_CHUNK_SIZE = int(os.environ.get('SYNC_CHUNK_SIZE', 100))
 
 # set configuration values
 class Config:
@@ -20,43 +52,296 @@ def connect_scheduler(app):
     scheduler.init_app(app)
 
 
+def background_job(job):
+    ''' Runs a job's GitHub calls in the background lane, so they give way to the routes when the rate limit runs low.
+        The run is stopped if the budget won't be back before the governor's maximum wait '''
+    @functools.wraps(job)
+    def wrapper(*args, **kwargs):
+        with github.governor.lane(BACKGROUND):
+            try:
+                return job(*args, **kwargs)
+            except RateLimitExceeded as e:
+                logger.warning("%s stopped early: %s", job.__name__, e)
+    return wrapper
 
-@scheduler.task('cron', id='update_ptoject_stacks', day='*')
-def update_project_stacks():
-    ''' Function to update the stack/languages used in all the repositeries '''
-    with scheduler.app.app_context():
-        projects = Project.query.all()
-        for p in projects:
-            stacks = get_stacks(p.git_repo)
-            existing_stacks = [stack.name for stack in p.stacks]
-            new_stacks = [stack for stack in stacks if stack not in existing_stacks]
-            if len(new_stacks) > 0:
-                stacks_in_db = Stack.query.filter(Stack.name.in_(new_stacks)).all()
-                p.stacks.extend(stacks_in_db)
-                db.session.commit()
 
 
+def advisory_lock_key(name):
+    ''' A stable 32 bit key for a Postgres advisory lock named after a job '''
+    return zlib.crc32(f"colab:{name}".encode())
 
-@scheduler.task('cron', id='update_ptoject_collabs', hour='*')
-def update_project_collaborators():
-    ''' Function to update the contributers in all the repositeries '''
-    with scheduler.app.app_context():
-        projects = Project.query.all()
+
+def leader_job(job):
+    ''' Runs a scheduled job only in the process that holds its Postgres advisory lock, so a single run happens across
+        all the processes of the deployment that start a scheduler. A run that finds the lock taken is skipped, which
+        coalesces it with the run in progress. The lock belongs to the connection, so it is released if the process dies
+        and another process takes the next run '''
+    key = advisory_lock_key(job.__name__)
+
+    @functools.wraps(job)
+    def wrapper(*args, **kwargs):
+        with scheduler.app.app_context(), db.engine.connect() as conn:
+            if not conn.execute(select(func.pg_try_advisory_lock(key))).scalar():
+                logger.info("%s is running in another process, skipped", job.__name__)
+                return None
+            try:
+                return job(*args, **kwargs)
+            finally:
+                conn.execute(select(func.pg_advisory_unlock(key)))
+    return wrapper
+
+
+def fetch_for_repos(fetch, repos, concurrency=None):
+    ''' Calls `fetch` once for every distinct repo on a bounded thread pool and returns a {repo: result} dict.
+        The workers run in the caller's governor lane, inside their own app context.
+        Repos that could not be fetched get False '''
+    repos = list(set(repos))
+    app = scheduler.app
+    lane = github.governor.current_lane()
+
+    def run(repo):
+        with app.app_context(), github.governor.lane(lane):
+            try:
+                return fetch(repo)
+            except (GitHubError, requests.RequestException) as e:
+                logger.warning("Fetching %s failed: %s", repo, e)
+                return False
+
+    with ThreadPoolExecutor(max_workers=concurrency or FETCH_CONCURRENCY) as pool:
+        return dict(zip(repos, pool.map(run, repos)))
+
+
+def fetch_metadata(repos, **fields):
+    ''' Fetches the metadata of the distinct repos with fetch_repo_metadata, GRAPHQL_BATCH_SIZE repos per query,
+        running the batches concurrently. Returns {repo: metadata}, with False for the repos of a failed batch '''
+    batches = [tuple(batch) for batch in chunked(sorted(set(repos)), GRAPHQL_BATCH_SIZE)]
+    metadata = {}
+    for batch, fetched in fetch_for_repos(lambda batch: fetch_repo_metadata(batch, **fields), batches).items():
+        metadata.update(fetched if fetched is not False else dict.fromkeys(batch, False))
+    return metadata
+
+
+def parse_github_time(value):
+    return datetime.strptime(value, "%Y-%m-%dT%H:%M:%SZ") if value else None
+
+
+def record_sync(project, meta, now):
+    ''' Updates the sync bookkeeping of a project after a refresh and schedules its next refresh.
+        Returns False if the refresh failed '''
+    if not meta or meta.get("collaborators") is False:
+        project.sync_failures += 1
+        project.next_sync_at = now + min(MIN_SYNC_INTERVAL * 2 ** project.sync_failures, MAX_SYNC_INTERVAL)
+        return False
+
+    pushed_at = parse_github_time(meta.get("pushed_at"))
+    pushed = pushed_at is not None and (project.pushed_at is None or pushed_at > project.pushed_at)
+    if pushed or project.sync_failures or project.last_synced_at is None:
+        interval = MIN_SYNC_INTERVAL
+    else:
+        # Dormant repository, back off
+        interval = min(max((project.next_sync_at - project.last_synced_at) * 2, MIN_SYNC_INTERVAL), MAX_SYNC_INTERVAL)
+
+    project.pushed_at = pushed_at or project.pushed_at
+    project.sync_failures = 0
+    project.last_synced_at = now
+    project.next_sync_at = now + interval
+    return True
+
+
+class StackIndex:
+    ''' An in-memory map of stack names to ids. The jobs load it once per run, and languages that are not stacks yet
+        are registered in bulk as they are met '''
+
+    def __init__(self):
+        self.ids = {}
+        self._lock = threading.Lock()
+
+    def load(self):
+        with self._lock:
+            self.ids = dict(db.session.query(Stack.name, Stack.id))
+
+    def resolve(self, names):
+        ''' Returns {name: id} for the names, inserting the unknown ones with an upsert so concurrent jobs can't clash '''
+        missing = sorted(set(names) - self.ids.keys())
+        if missing:
+            stmt = insert(Stack).values([{"name": name} for name in missing])
+            stmt = stmt.on_conflict_do_update(index_elements=[Stack.name], set_={"name": stmt.excluded.name})
+            rows = db.session.execute(stmt.returning(Stack.name, Stack.id)).all()
+            metrics.count_rows("stacks", "upsert", len(rows))
+            reference_data.bump(db.session)
+            with self._lock:
+                self.ids.update(rows)
+        return {name: self.ids[name] for name in names}
+
+
+stack_index = StackIndex()
+
+
+def sync_stacks(projects, metadata):
+    ''' Links the projects to the languages GitHub reports for their repositories, with the share of the bytes of each,
+        and sets their primary stack. Languages a repository no longer reports keep their link with a share of 0.
+        One query loads the existing links, one insert adds the new ones and one executemany updates the changed
+        shares. The preference matches of the projects that gained a stack are refreshed. The caller commits '''
+    fetched = {p.id: language_shares(metadata[p.git_repo]["languages"]) for p in projects if metadata[p.git_repo]}
+    if not fetched:
+        return
+
+    ids = stack_index.resolve({name for shares in fetched.values() for name in shares})
+    wanted = {project_id: {ids[name]: share for name, share in shares.items()} for project_id, shares in fetched.items()}
+    existing = {(project_id, stack_id): (link_id, share) for link_id, project_id, stack_id, share in
+                db.session.query(ProjectStack.id, ProjectStack.project_id, ProjectStack.stack_id, ProjectStack.share)
+                .filter(ProjectStack.project_id.in_(fetched))}
+
+    to_add = []
+    to_update = []
+    for project_id, shares in wanted.items():
+        for stack_id, share in shares.items():
+            if (project_id, stack_id) not in existing:
+                to_add.append({"project_id": project_id, "stack_id": stack_id, "share": share})
+    for (project_id, stack_id), (link_id, share) in existing.items():
+        new_share = wanted[project_id].get(stack_id, 0)
+        if share != new_share:
+            to_update.append({"id": link_id, "share": new_share})
+
+    if to_add:
+        # A webhook sync of the same project may have linked the stack since the links were loaded
+        stmt = insert(ProjectStack).on_conflict_do_nothing(index_elements=[ProjectStack.project_id, ProjectStack.stack_id])
+        db.session.execute(stmt, to_add)
+        metrics.count_rows("project_stacks", "insert", len(to_add))
+        # Links are never removed here, so only the projects that gained a stack can match more users
+        UserProjectMatch.refresh(project_ids={link["project_id"] for link in to_add})
+    if to_update:
+        db.session.bulk_update_mappings(ProjectStack, to_update)
+        metrics.count_rows("project_stacks", "update", len(to_update))
+
+    for p in projects:
+        if p.id in wanted:
+            shares = wanted[p.id]
+            p.primary_stack_id = max(shares, key=shares.get) if shares else None
+
+
+def load_links(model, column, project_ids):
+    ''' Returns {project_id: set of values of the column} for the rows of a project link table '''
+    links = {}
+    for project_id, value in db.session.query(model.project_id, getattr(model, column)).filter(model.project_id.in_(project_ids)):
+        links.setdefault(project_id, set()).add(value)
+    return links
+
+
+def write_links(model, column, wanted, existing):
+    ''' Inserts and deletes the rows of a project link table so the projects of `wanted` are linked to exactly
+        their wanted values, with one insert and one delete. Links another job added meanwhile are left as they are '''
+    to_add = []
+    to_remove = []
+    for project_id, values in wanted.items():
+        current = existing.get(project_id, set())
+        to_add.extend({"project_id": project_id, column: value} for value in values - current)
+        to_remove.extend((project_id, value) for value in current - values)
+
+    if to_add:
+        stmt = insert(model).on_conflict_do_nothing(index_elements=[model.project_id, getattr(model, column)])
+        db.session.execute(stmt, to_add)
+        metrics.count_rows(model.__tablename__, "insert", len(to_add))
+    if to_remove:
+        deleted = (model.query
+                   .filter(db.tuple_(model.project_id, getattr(model, column)).in_(to_remove))
+                   .delete(synchronize_session=False))
+        metrics.count_rows(model.__tablename__, "delete", deleted)
+
+
+def sync_collaborators(projects, metadata):
+    ''' Records the contributors of the projects' repositories, links the projects to the contributors that are users,
+        and unlinks the ones that no longer contribute. Every contributor is kept, users or not, so a user who
+        registers later is linked from them right away (see User.backfill_collaborations).
+        The existing rows are loaded once for all the projects, and the changes are written with one insert and
+        one delete per table and SYNC_CHUNK_SIZE projects '''
+    fetched = {p.id: set(metadata[p.git_repo]["collaborators"]) for p in projects
+               if metadata[p.git_repo] and metadata[p.git_repo]["collaborators"] is not False}
+    if not fetched:
+        return
+
+    # Only the contributors that are users are collaborators
+    handles = set().union(*fetched.values())
+    usernames = dict(db.session.query(User.git_handle, User.username).filter(User.git_handle.in_(handles))) if handles else {}
+
+    contributors = load_links(ProjectContributor, "login", fetched)
+    collaborators = load_links(Collaboration, "username", fetched)
+
+    for chunk in chunked(sorted(fetched), SYNC_CHUNK_SIZE):
+        write_links(ProjectContributor, "login", {project_id: fetched[project_id] for project_id in chunk}, contributors)
+        write_links(Collaboration, "username",
+                    {project_id: {usernames[handle] for handle in fetched[project_id] if handle in usernames} for project_id in chunk},
+                    collaborators)
+        db.session.commit()
+
+
+@scheduler.task('interval', id='refresh_due_projects', minutes=SYNC_TICK_MINUTES, coalesce=True, max_instances=1)
+@leader_job
+@background_job
+def refresh_due_projects():
+    ''' Refreshes the stacks and collaborators of the projects that are due, most overdue first, SYNC_BUDGET projects per tick.
+        Repositories pushed to recently come due often and dormant ones rarely, so the work follows the changes on GitHub
+        rather than the number of projects. Webhooks refresh projects in between '''
+    with scheduler.app.app_context(), metrics.job_timer("refresh_due_projects"):
+        stack_index.load()
+        now = datetime.utcnow()
+        projects = (Project.query
+                    .filter(Project.next_sync_at <= now)
+                    .order_by(Project.next_sync_at)
+                    .limit(SYNC_BUDGET)
+                    .all())
+        metadata = fetch_metadata([p.git_repo for p in projects])
         for p in projects:
-            collabs = get_collaborators(p.git_repo)
-            existing_collabs = [collab.git_handle for collab in p.collaborators]
-            new_collabs = [collab for collab in collabs if collab not in existing_collabs] 
-            to_be_removed_collabs = [collab for collab in existing_collabs if collab not in collabs]
- 
-            if len(new_collabs) > 0:
-                collabs_in_db = User.query.filter(User.git_handle.in_(new_collabs)).all()
-                p.collaborators.extend(collabs_in_db)
-                db.session.commit()
+            record_sync(p, metadata[p.git_repo], now)
+        sync_stacks(projects, metadata)
+        sync_collaborators(projects, metadata)
+        db.session.commit()
+        metrics.count_projects(len(projects))
 
-            if len(to_be_removed_collabs) > 0:
-                collabs_in_db = [u.username for u in User.query.filter(User.git_handle.in_(to_be_removed_collabs)).all()]
-                Collaboration.query.filter(Collaboration.username.in_(collabs_in_db) & Collaboration.project_id == p.id).delete()
-                db.session.commit()
+
+def mark_sync_failed(project_id):
+    ''' Marks a project whose stacks and collaborators could not be fetched '''
+    project = Project.query.get(project_id)
+    if project:
+        project.sync_status = "failed"
+        db.session.commit()
+
+
+@job_handler("sync_project", on_give_up=mark_sync_failed)
+def sync_project(project_id):
+    ''' Fetches the stacks and collaborators of a new, edited or webhook-notified project '''
+    project = Project.query.get(project_id)
+    if project is None:
+        return
+
+    metadata = fetch_repo_metadata([project.git_repo])
+    meta = metadata[project.git_repo]
+    if meta is None:
+        raise GitHubError(project.git_repo, 404)
+    if meta["collaborators"] is False:
+        raise GitHubError(project.git_repo, None)
+
+    sync_stacks([project], metadata)
+    sync_collaborators([project], metadata)
+    project.sync_status = "synced"
+    record_sync(project, meta, datetime.utcnow())
+    db.session.commit()
+    metrics.count_projects(1)
+
+
+def enqueue_project_sync(project_id):
+    ''' Queues a sync of a project in the caller's session. A sync that is already waiting for the project is reused '''
+    enqueue("sync_project", {"project_id": project_id}, key=f"sync_project:{project_id}")
+
+
+@scheduler.task('interval', id='run_jobs', seconds=JOB_POLL_SECONDS, coalesce=True, max_instances=1)
+@background_job
+def run_jobs():
+    ''' Worker of the job queue. Jobs are claimed with SKIP LOCKED, so every scheduler process can run it at once '''
+    with scheduler.app.app_context():
+        stack_index.load()
+        while run_pending_jobs():
+            pass
 
 
 '''
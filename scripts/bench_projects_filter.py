@@ -0,0 +1,136 @@
+''' Benchmarks the /projects filter query, comparing the EXISTS filter of app.filter_projects with the outer joins it replaced,
+and the preferred only page and the upkeep of the preference matches behind it.
+
+    DATABASE_URL=postgres:///colab-bench python scripts/bench_projects_filter.py --projects 10000 --users 10000
+
+The database is dropped and recreated, so never point it at a real database.
+'''
+import argparse
+import os
+import random
+import sys
+import time
+
+from sqlalchemy.exc import OperationalError
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from app import app, filter_projects, page_projects
+from models import (db, User, Sector, Stack, Project, ProjectStack, Collaboration, ProjectContributor, UserPreferenceSector,
+                    UserPreferenceStack, UserProjectMatch, SECTORS)
+
+STACKS = ["Python", "JavaScript", "Go", "Rust", "C", "Java", "Ruby", "Shell", "HTML", "CSS", "TypeScript", "Kotlin"]
+
+
+def seed(projects, users, seed=0):
+    rnd = random.Random(seed)
+    db.drop_all()
+    db.create_all()
+    db.session.add_all([Sector(name=sector) for sector in SECTORS])
+    db.session.add_all([Stack(name=name) for name in STACKS])
+    db.session.commit()
+    sectors = [s.id for s in Sector.query]
+    stacks = [s.id for s in Stack.query]
+
+    db.session.execute(db.insert(User), [dict(username=f"user{i}", email=f"user{i}@example.com", first_name="User", last_name=str(i),
+                                              git_handle=f"user{i}", password="x") for i in range(users)])
+    db.session.execute(db.insert(Project), [dict(title=f"Project {i}", git_repo=f"user{i % users}/repo{i}", owned_by=f"user{i % users}",
+                                                 sector_id=rnd.choice(sectors), sync_failures=0, sync_status="synced")
+                                            for i in range(projects)])
+    project_ids = [id for (id,) in db.session.query(Project.id)]
+    links = []
+    for project_id in project_ids:
+        chosen = rnd.sample(stacks, 3)
+        links.extend(dict(project_id=project_id, stack_id=stack_id, share=share) for stack_id, share in zip(chosen, (0.7, 0.2, 0.1)))
+    db.session.execute(db.insert(ProjectStack), links)
+    # Two contributors per project, one of them a user
+    db.session.execute(db.insert(ProjectContributor), [dict(project_id=project_id, login=login) for i, project_id in enumerate(project_ids)
+                                                       for login in (f"user{(i + 1) % users}", f"outsider{i}")])
+    db.session.execute(db.insert(Collaboration), [dict(project_id=project_id, username=f"user{(i + 1) % users}")
+                                                  for i, project_id in enumerate(project_ids)])
+    db.session.execute(db.insert(UserPreferenceStack), [dict(username=f"user{i}", stack_id=stack_id)
+                                                        for i in range(users) for stack_id in rnd.sample(stacks, 3)])
+    db.session.execute(db.insert(UserPreferenceSector), [dict(username=f"user{i}", sector_id=sector_id)
+                                                         for i in range(users) for sector_id in rnd.sample(sectors, 2)])
+    db.session.commit()
+    start = time.perf_counter()
+    UserProjectMatch.refresh()
+    db.session.commit()
+    print(f"preference matches of every user built in {time.perf_counter() - start:.2f}s, {UserProjectMatch.query.count()} rows")
+    return sectors, stacks
+
+
+def joined_filter(username, sectors, stacks, preferred_only):
+    ''' The outer join query of /projects before the EXISTS rewrite, deduplicated in Python '''
+    query = (db.session.query(Project, ProjectStack, Stack, Sector, UserPreferenceSector, UserPreferenceStack)
+             .outerjoin(ProjectStack, Project.id == ProjectStack.project_id)
+             .outerjoin(Stack, ProjectStack.stack_id == Stack.id)
+             .outerjoin(Sector, Project.sector_id == Sector.id)
+             .outerjoin(UserPreferenceSector, (Project.sector_id == UserPreferenceSector.sector_id))
+             .outerjoin(UserPreferenceStack, (ProjectStack.stack_id == UserPreferenceStack.stack_id))
+             .filter((Project.owned_by != username) & ((Stack.id.in_(stacks)) | (Sector.id.in_(sectors)))))
+    if preferred_only:
+        query = query.filter((UserPreferenceStack.username == username) | (UserPreferenceSector.username == username))
+    rows = query.all()
+    return list(set(q[0] for q in rows)), len(rows)
+
+
+def exists_filter(username, sectors, stacks, preferred_only):
+    query, rank = filter_projects(Project.query.filter(Project.owned_by != username), sectors, stacks,
+                                  preferred_by=username if preferred_only else None)
+    projects, _ = page_projects(query, rank, size=Project.query.count())
+    return projects, len(projects)
+
+
+def bench_matches(username):
+    ''' Times the preferred only page and the refreshes of the preference matches '''
+    project_id = db.session.query(Project.id).filter(Project.owned_by != username).order_by(Project.id).limit(1).scalar()
+    steps = [("preferred only, first page", lambda: page_projects(*filter_projects(Project.query.filter(Project.owned_by != username),
+                                                                                   preferred_by=username))),
+             ("matches of a user refreshed", lambda: UserProjectMatch.refresh(usernames=[username])),
+             ("matches of a project refreshed", lambda: UserProjectMatch.refresh(project_ids=[project_id]))]
+    for label, step in steps:
+        start = time.perf_counter()
+        step()
+        db.session.rollback()
+        print(f"{label}: {(time.perf_counter() - start) * 1000:.1f}ms")
+
+
+def bench(name, func, timeout, *args):
+    db.session.expunge_all()
+    db.session.execute(db.text(f"SET LOCAL statement_timeout = {int(timeout * 1000)}"))
+    start = time.perf_counter()
+    try:
+        projects, rows = func(*args)
+    except OperationalError:
+        print(f"{name}: cancelled after {timeout:.0f}s")
+        return None
+    finally:
+        db.session.rollback()
+    elapsed = time.perf_counter() - start
+    print(f"{name}: {elapsed:.2f}s, {rows} rows fetched for {len(projects)} projects")
+    return {p.id for p in projects}
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the /projects filter query")
+    parser.add_argument("--projects", type=int, default=10000)
+    parser.add_argument("--users", type=int, default=10000)
+    parser.add_argument("--timeout", type=float, default=60, help="Seconds after which a query is cancelled")
+    args = parser.parse_args()
+
+    app.config['SQLALCHEMY_ECHO'] = False
+    with app.app_context():
+        sectors, stacks = seed(args.projects, args.users)
+        cases = [("one stack", [], stacks[:1], False),
+                 ("two stacks and a sector, preferred only", sectors[:1], stacks[:2], True)]
+        for label, case_sectors, case_stacks, preferred_only in cases:
+            found = bench(f"{label}, EXISTS", exists_filter, args.timeout, "user0", case_sectors, case_stacks, preferred_only)
+            joined = bench(f"{label}, outer joins", joined_filter, args.timeout, "user0", case_sectors, case_stacks, preferred_only)
+            if found is not None and joined is not None and found != joined:
+                print(f"  the two queries disagree on {len(found ^ joined)} projects")
+        bench_matches("user0")
+
+
+if __name__ == "__main__":
+    main()
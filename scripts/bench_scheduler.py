@@ -0,0 +1,62 @@
+''' Benchmarks the scheduler refresh jobs against the local fake GitHub API.
+
+    DATABASE_URL=postgres:///colab-bench python scripts/bench_scheduler.py --projects 2000 --latency 0.05
+
+The database is dropped and recreated, so never point it at a real database.
+'''
+import argparse
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import git
+from app import app
+from fake_github import FakeGitHub
+from models import db, User, Sector, Stack, Project, SECTORS
+from schedule import refresh_due_projects, SYNC_BUDGET
+
+
+def seed(projects, users):
+    db.drop_all()
+    db.create_all()
+    db.session.add_all([Sector(name=sector) for sector in SECTORS])
+    db.session.add_all([Stack(name=name) for name in ["Python", "JavaScript", "Go", "Rust", "C"]])
+    db.session.add_all([User(username=f"user{i}", email=f"user{i}@example.com", first_name="User", last_name=str(i),
+                             git_handle=f"user{i}", password="x") for i in range(users)])
+    db.session.commit()
+    db.session.bulk_save_objects([Project(title=f"Project {i}", git_repo=f"owner/repo{i}", owned_by=f"user{i % users}", sector_id=1)
+                                  for i in range(projects)])
+    db.session.commit()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the scheduler refresh jobs against a fake GitHub API")
+    parser.add_argument("--projects", type=int, default=1000)
+    parser.add_argument("--users", type=int, default=500)
+    parser.add_argument("--latency", type=float, default=0.05)
+    parser.add_argument("--error-rate", type=float, default=0)
+    args = parser.parse_args()
+
+    app.config['SQLALCHEMY_ECHO'] = False
+    fake = FakeGitHub(latency=args.latency, error_rate=args.error_rate)
+    fake.populate(args.projects)
+    git.GIT_API_BASE_URL = fake.start()
+
+    with app.app_context():
+        seed(args.projects, args.users)
+
+    # The first ticks refresh every project, SYNC_BUDGET at a time. The last one finds nothing due.
+    for tick in range((args.projects + SYNC_BUDGET - 1) // SYNC_BUDGET + 1):
+        fake.requests.clear()
+        start = time.perf_counter()
+        refresh_due_projects()
+        elapsed = time.perf_counter() - start
+        print(f"refresh_due_projects tick {tick}: {elapsed:.2f}s, {len(fake.requests)} GitHub requests for {args.projects} projects")
+
+    fake.stop()
+
+
+if __name__ == "__main__":
+    main()
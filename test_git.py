@@ -1,10 +1,37 @@
 from unittest import TestCase
+import requests
+from types import SimpleNamespace
 
-from git import get_stacks, get_collaborators, validate_git_handle_ownership, validate_repo_existence
+import time
+import git
+from fake_github import FakeGitHub
+from git import get_stacks, get_collaborators, validate_git_handle_ownership, validate_repo_existence, GitHubClient, github, RateLimitGovernor, RateLimitExceeded, GitHubError, BACKGROUND, chunked, fetch_repo_metadata, TTLCache, validation_cache
 
-class GitFunctionsTestCase(TestCase):
+
+class FakeGitHubTestCase(TestCase):
+    """Runs the tests of the class against a local fake GitHub API."""
+
+    @classmethod
+    def setUpClass(cls):
+        cls.fake = FakeGitHub()
+        cls.fake.add_repo("Kidist-Abraham/Colab", languages={"Python": 60000, "HTML": 20000}, contributors=["Kidist-Abraham"])
+        cls.fake.add_repo("Kidist-Abraham/SPI-communication-", languages={"C": 5000})
+        cls.fake.add_user("Kidist-Abraham", email="kidistabraham@gmail.com")
+        cls.base_url = git.GIT_API_BASE_URL
+        git.GIT_API_BASE_URL = cls.fake.start()
+
+    @classmethod
+    def tearDownClass(cls):
+        git.GIT_API_BASE_URL = cls.base_url
+        cls.fake.stop()
+
+
+class GitFunctionsTestCase(FakeGitHubTestCase):
     """Test git functions."""
 
+    def setUp(self):
+        validation_cache.clear()
+
 
     def test_get_repo_stack(self):
         """ Does get_stacks function return the languages that are used the repository """
@@ -41,4 +68,326 @@ class GitFunctionsTestCase(TestCase):
 
         # Should return True if the the repo exists
         exist = validate_repo_existence("Kidist-Abraham/SPI-communication-")
-        self.assertTrue(exist)
\ No newline at end of file
+        self.assertTrue(exist)
+
+
+class GitHubClientTestCase(TestCase):
+    """Test the pooled GitHub client."""
+
+
+    def test_shared_client_is_reused(self):
+        """ Do the helpers share one session instead of opening a new connection per call """
+
+        self.assertIs(github.session, github.session)
+        adapter = github.session.get_adapter("https://api.github.com")
+        self.assertEqual(adapter._pool_maxsize, 10)
+
+
+    def test_client_configuration(self):
+        """ Are the pool size, timeouts and retries configurable """
+
+        client = GitHubClient(token="abc", pool_size=4, connect_timeout=1, read_timeout=2, retries=5, backoff_factor=1)
+        adapter = client.session.get_adapter("https://api.github.com")
+
+        self.assertEqual(client.timeout, (1, 2))
+        self.assertEqual(adapter._pool_maxsize, 4)
+        self.assertEqual(adapter.max_retries.total, 5)
+        self.assertIn(503, adapter.max_retries.status_forcelist)
+        self.assertEqual(client.session.headers["Authorization"], "token abc")
+
+
+class DictCache:
+    """An in-memory stand-in for the validator cache table."""
+
+    def __init__(self):
+        self.rows = {}
+
+    def load(self, url):
+        return self.rows.get(url)
+
+    def store(self, url, etag, last_modified, payload, next_url=None):
+        self.rows[url] = SimpleNamespace(etag=etag, last_modified=last_modified, payload=payload, next_url=next_url)
+
+
+class CannedClient(GitHubClient):
+    """A client that answers from a list of canned responses and records the request headers."""
+
+    def __init__(self, responses, **kwargs):
+        super().__init__(**kwargs)
+        self.responses = responses
+        self.sent_headers = []
+        self.session.request = self.answer
+
+    def answer(self, method, url, **kwargs):
+        self.sent_headers.append(kwargs.get("headers", {}))
+        status, body, headers = self.responses.pop(0)
+        resp = requests.Response()
+        resp.status_code = status
+        resp._content = body
+        resp.headers.update(headers)
+        return resp
+
+
+class ConditionalRequestTestCase(TestCase):
+    """Test the ETag / If-Modified-Since cache."""
+
+
+    def test_not_modified_reuses_cached_payload(self):
+        """ Does a 304 answer return the payload cached from the previous 200 """
+
+        client = CannedClient([(200, b'{"Python": 100}', {"ETag": '"v1"', "Last-Modified": "Mon, 01 Aug 2022 00:00:00 GMT"}),
+                               (304, b"", {})],
+                              cache=DictCache())
+
+        self.assertEqual(client.get_json("http://git/repos/a/b/languages"), (200, {"Python": 100}))
+        self.assertEqual(client.get_json("http://git/repos/a/b/languages"), (200, {"Python": 100}))
+
+        # The second request carries the validators of the first response
+        self.assertEqual(client.sent_headers[0], {})
+        self.assertEqual(client.sent_headers[1]["If-None-Match"], '"v1"')
+        self.assertEqual(client.sent_headers[1]["If-Modified-Since"], "Mon, 01 Aug 2022 00:00:00 GMT")
+
+
+    def test_parsed_payload_is_cached(self):
+        """ Is the payload reduced by `parse` before it is cached """
+
+        cache = DictCache()
+        client = CannedClient([(200, b'[{"login": "a", "id": 1}]', {"ETag": '"v1"'})], cache=cache)
+
+        self.assertEqual(client.get_json("http://git/c", parse=lambda body: [r["login"] for r in body]), (200, ["a"]))
+        self.assertEqual(cache.load("http://git/c").payload, ["a"])
+
+
+
+class PaginationTestCase(TestCase):
+    """Test following the Link headers of paginated resources."""
+
+
+    def test_pages_are_followed(self):
+        """ Does iter_pages follow rel="next" links and reuse the cached next link on a 304 """
+
+        cache = DictCache()
+        link = '<http://git/c?page=2>; rel="next", <http://git/c?page=2>; rel="last"'
+        client = CannedClient([(200, b'[1, 2]', {"ETag": '"p1"', "Link": link}),
+                               (200, b'[3]', {"ETag": '"p2"'}),
+                               (304, b"", {}),
+                               (304, b"", {})],
+                              cache=cache)
+
+        self.assertEqual(list(client.iter_pages("http://git/c")), [[1, 2], [3]])
+        self.assertEqual(list(client.iter_pages("http://git/c")), [[1, 2], [3]])
+
+
+    def test_max_pages(self):
+        """ Does iter_pages stop at max_pages and raise on a failed page """
+
+        link = '<http://git/c?page=2>; rel="next"'
+        client = CannedClient([(200, b'[1]', {"Link": link}), (200, b'[2]', {"Link": link}), (404, b"{}", {})])
+
+        self.assertEqual(list(client.iter_pages("http://git/c", max_pages=1)), [[1]])
+        with self.assertRaises(GitHubError):
+            list(client.iter_pages("http://git/c"))
+
+
+    def test_chunked(self):
+        """ Does chunked split an iterable lazily into lists """
+
+        self.assertEqual(list(chunked(iter(range(5)), 2)), [[0, 1], [2, 3], [4]])
+
+
+def rate_limit_headers(remaining, limit=100, reset_in=600):
+    return {"X-RateLimit-Limit": str(limit), "X-RateLimit-Remaining": str(remaining), "X-RateLimit-Reset": str(int(time.time()) + reset_in)}
+
+
+class RateLimitGovernorTestCase(TestCase):
+    """Test the rate limit governor."""
+
+
+    def test_background_lane_leaves_the_reserve(self):
+        """ Do background calls stop at the interactive reserve while interactive calls go on """
+
+        client = CannedClient([(200, b"{}", rate_limit_headers(20)), (200, b"{}", rate_limit_headers(19))],
+                              governor=RateLimitGovernor(interactive_reserve=0.2, max_background_wait=60))
+
+        with client.governor.lane(BACKGROUND):
+            client.get("http://git/a")
+            # 20 of 100 tokens are reserved and the reset is further away than the maximum wait
+            with self.assertRaises(RateLimitExceeded):
+                client.get("http://git/a")
+
+        client.get("http://git/a")
+        self.assertEqual(client.governor.bucket().remaining, 19)
+        self.assertEqual(client.governor.state()["buckets"]["core"]["remaining"], 19)
+        self.assertEqual(client.governor.state()["rejected"], {"interactive": 0, "background": 1})
+
+
+    def test_interactive_lane_raises_on_rate_limit_answer(self):
+        """ Is a 403 rate limit answer raised instead of being mistaken for a missing resource """
+
+        client = CannedClient([(403, b"{}", rate_limit_headers(0))])
+
+        with self.assertRaises(RateLimitExceeded):
+            client.get("http://git/a")
+
+        # The bucket is empty until the reset, so no request goes out
+        with self.assertRaises(RateLimitExceeded):
+            client.get("http://git/a")
+        self.assertEqual(len(client.sent_headers), 1)
+
+
+    def test_bucket_refills_after_reset(self):
+        """ Does the governor let calls through again after the reset time """
+
+        client = CannedClient([(200, b"{}", rate_limit_headers(0, reset_in=-1)), (200, b"{}", rate_limit_headers(99))])
+
+        client.get("http://git/a")
+        client.get("http://git/a")
+        self.assertEqual(client.governor.bucket().remaining, 99)
+
+
+class FetchRepoMetadataTestCase(FakeGitHubTestCase):
+    """Test the batched GraphQL fetch against the fake GraphQL endpoint."""
+
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        cls.fake.add_repo("kid/small", languages={"Python": 900, "HTML": 100}, contributors=["kid", "bo"], pushed_at="2022-08-01T00:00:00Z")
+        cls.fake.add_repo("kid/big", contributors=[f"user{i}" for i in range(150)])
+
+
+    def test_batch_is_one_query(self):
+        """ Does fetch_repo_metadata fetch languages, sizes and collaborators of many repos with one query """
+
+        self.fake.requests.clear()
+        metadata = fetch_repo_metadata(["kid/small", "kid/missing"])
+
+        self.assertEqual(self.fake.requests, [("POST", "/graphql")])
+        self.assertEqual(metadata["kid/small"], {"pushed_at": "2022-08-01T00:00:00Z",
+                                                 "languages": {"Python": 900, "HTML": 100},
+                                                 "collaborators": ["kid", "bo"]})
+        self.assertIsNone(metadata["kid/missing"])
+
+
+    def test_long_history_falls_back_to_rest(self):
+        """ Are the contributors of a repo with more than one page of history read from REST """
+
+        metadata = fetch_repo_metadata(["kid/big"], languages=False)
+
+        self.assertEqual(metadata["kid/big"]["collaborators"], [f"user{i}" for i in range(150)])
+        self.assertNotIn("languages", metadata["kid/big"])
+
+
+class FakeGitHubServerTestCase(FakeGitHubTestCase):
+    """Test the helpers against the pagination, ETags, errors and rate limit of the fake GitHub API."""
+
+
+    def test_contributors_pagination(self):
+        """ Does get_collaborators read every page of contributors """
+
+        self.fake.add_repo("kid/popular", contributors=[f"user{i}" for i in range(250)])
+        self.fake.requests.clear()
+
+        self.assertEqual(list(get_collaborators("kid/popular")), [f"user{i}" for i in range(250)])
+        self.assertEqual(len(self.fake.requests), 3)
+
+
+    def test_etag_not_modified(self):
+        """ Does the fake answer a matching If-None-Match with a 304 """
+
+        url = f"{git.GIT_API_BASE_URL}/repos/Kidist-Abraham/Colab/languages"
+        etag = requests.get(url).headers["ETag"]
+
+        self.assertEqual(requests.get(url, headers={"If-None-Match": etag}).status_code, 304)
+
+
+    def test_rate_limit_and_errors(self):
+        """ Does the fake send rate limit headers, answer 403 when the limit is spent and inject errors """
+
+        fake = FakeGitHub(rate_limit=2, error_rate=0)
+        fake.add_repo("a/b")
+        base_url = fake.start()
+        try:
+            first = requests.get(f"{base_url}/repos/a/b")
+            self.assertEqual(first.headers["X-RateLimit-Remaining"], "1")
+            requests.get(f"{base_url}/repos/a/b")
+            self.assertEqual(requests.get(f"{base_url}/repos/a/b").status_code, 403)
+
+            fake.error_rate = 1
+            self.assertEqual(requests.get(f"{base_url}/users/x").status_code, 502)
+        finally:
+            fake.stop()
+
+
+    def test_replay(self):
+        """ Are recorded responses replayed """
+
+        fake = FakeGitHub()
+        fake.recordings["GET /users/recorded"] = {"status": 200, "headers": {}, "body": {"login": "recorded", "email": "r@example.com"}}
+        base_url = fake.start()
+        try:
+            self.assertEqual(requests.get(f"{base_url}/users/recorded").json()["email"], "r@example.com")
+        finally:
+            fake.stop()
+
+
+class TTLCacheTestCase(TestCase):
+    """Test the TTL cache of the validators."""
+
+
+    def test_expiry(self):
+        """ Do negative results expire after their own, shorter lifetime """
+
+        cache = TTLCache(ttl=60, negative_ttl=0)
+        cache.set("yes", True)
+        cache.set("no", False)
+
+        self.assertEqual(cache.get("yes"), (True, True))
+        self.assertEqual(cache.get("no"), (False, None))
+
+
+    def test_lru_eviction(self):
+        """ Is the least recently used entry evicted when the cache is full """
+
+        cache = TTLCache(maxsize=2)
+        cache.set("a", True)
+        cache.set("b", True)
+        cache.get("a")
+        cache.set("c", True)
+
+        self.assertTrue(cache.get("a")[0])
+        self.assertFalse(cache.get("b")[0])
+        self.assertTrue(cache.get("c")[0])
+
+
+class ValidationCacheTestCase(FakeGitHubTestCase):
+    """Test that the validators answer repeated checks from the cache."""
+
+    def setUp(self):
+        validation_cache.clear()
+        self.fake.requests.clear()
+
+
+    def test_repeated_validation_is_cached(self):
+        """ Do repeated checks of the same repo and handle go to GitHub once """
+
+        for _ in range(3):
+            self.assertTrue(validate_repo_existence("Kidist-Abraham/Colab"))
+            self.assertFalse(validate_repo_existence("Kidist-Abraham/doesn-t-exist"))
+            self.assertTrue(validate_git_handle_ownership("Kidist-Abraham", "kidistabraham@gmail.com", False))
+
+        self.assertEqual(len(self.fake.requests), 3)
+
+
+    def test_server_errors_are_not_cached(self):
+        """ Is a failed check asked again instead of being cached as a negative answer """
+
+        self.fake.error_rate = 1
+        git.github = GitHubClient(retries=0)
+        try:
+            self.assertFalse(validate_repo_existence("Kidist-Abraham/Colab"))
+        finally:
+            self.fake.error_rate = 0
+            git.github = github
+
+        self.assertTrue(validate_repo_existence("Kidist-Abraham/Colab"))
+
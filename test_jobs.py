@@ -0,0 +1,99 @@
+from unittest import TestCase
+from datetime import datetime, timedelta
+
+from models import db, Job
+from app import app
+from jobs import job_handler, enqueue, run_pending_jobs, MAX_ATTEMPTS
+from schedule import scheduler
+
+app.config['SQLALCHEMY_DATABASE_URI'] = "postgresql:///colab-test"
+app.config['SQLALCHEMY_ECHO'] = False
+
+db.create_all()
+
+calls = []
+given_up = []
+
+
+@job_handler("test_record")
+def record(value):
+    calls.append(value)
+
+
+@job_handler("test_fail", on_give_up=lambda value: given_up.append(value))
+def fail(value):
+    raise ValueError(value)
+
+
+class JobQueueTestCase(TestCase):
+    """Test the durable job queue."""
+
+    @classmethod
+    def setUpClass(cls):
+        scheduler.pause()
+
+    @classmethod
+    def tearDownClass(cls):
+        scheduler.resume()
+
+    def setUp(self):
+        Job.query.delete()
+        db.session.commit()
+        calls.clear()
+        given_up.clear()
+
+
+    def test_jobs_run_once(self):
+        """ Are queued jobs run once, and are jobs with the same key queued once """
+
+        enqueue("test_record", {"value": 1}, key="record:1")
+        enqueue("test_record", {"value": 1}, key="record:1")
+        enqueue("test_record", {"value": 2})
+        db.session.commit()
+
+        self.assertEqual(run_pending_jobs(), 2)
+        self.assertEqual(run_pending_jobs(), 0)
+        self.assertEqual(sorted(calls), [1, 2])
+        self.assertEqual({job.status for job in Job.query.all()}, {"done"})
+
+
+    def test_delayed_jobs_wait(self):
+        """ Are jobs only run once they are due """
+
+        enqueue("test_record", {"value": 1}, delay=timedelta(minutes=5))
+        db.session.commit()
+
+        self.assertEqual(run_pending_jobs(), 0)
+
+
+    def test_failed_jobs_are_retried(self):
+        """ Is a failing job retried with a backoff, then given up after the last attempt """
+
+        job = enqueue("test_fail", {"value": "boom"})
+        db.session.commit()
+
+        run_pending_jobs()
+        job = Job.query.get(job.id)
+        self.assertEqual((job.status, job.attempts), ("queued", 1))
+        self.assertGreater(job.run_after, datetime.utcnow())
+        self.assertIn("ValueError: boom", job.last_error)
+
+        for _ in range(MAX_ATTEMPTS - 1):
+            job.run_after = datetime.utcnow()
+            db.session.commit()
+            run_pending_jobs()
+
+        job = Job.query.get(job.id)
+        self.assertEqual((job.status, job.attempts), ("failed", MAX_ATTEMPTS))
+        self.assertEqual(given_up, ["boom"])
+
+
+    def test_lost_jobs_are_reclaimed(self):
+        """ Is a job left running by a dead worker run again after the timeout """
+
+        db.session.add(Job(kind="test_record", payload={"value": 3}, status="running", attempts=1,
+                           locked_at=datetime.utcnow() - timedelta(hours=1)))
+        db.session.commit()
+
+        self.assertEqual(run_pending_jobs(), 1)
+        self.assertEqual(calls, [3])
@@ -0,0 +1,74 @@
+from unittest import TestCase
+
+from sqlalchemy import event
+
+from app import app
+from models import db, Stack, ReferenceVersion
+from reference import ReferenceData, reference_data, VERSION_NAME
+
+app.config['SQLALCHEMY_DATABASE_URI'] = "postgresql:///colab-test"
+app.config['SQLALCHEMY_ECHO'] = False
+
+db.create_all()
+
+
+class ReferenceDataTestCase(TestCase):
+    """Test the cache of the sectors and stacks."""
+
+    def setUp(self):
+        Stack.query.filter(Stack.name.in_(["Cobol", "Fortran"])).delete(synchronize_session=False)
+        db.session.commit()
+
+    def tearDown(self):
+        db.session.rollback()
+
+
+    def count_queries(self, func):
+        statements = []
+
+        def record(conn, cursor, statement, *args):
+            statements.append(statement)
+
+        event.listen(db.engine, "before_cursor_execute", record)
+        try:
+            func()
+        finally:
+            event.remove(db.engine, "before_cursor_execute", record)
+        return len(statements)
+
+
+    def test_cached_between_checks(self):
+        """ Is the data served from memory until the next check of the version stamp """
+
+        cache = ReferenceData(check_seconds=3600)
+        cache.refresh()
+
+        self.assertEqual(self.count_queries(cache.refresh), 0)
+        self.assertEqual(cache.stack_names, {id: name for id, name in cache.stack_choices})
+
+
+    def test_invalidated_on_change(self):
+        """ Does adding a stack reach the cache of the process at once, and bump the version stamp for the others """
+
+        reference_data.refresh()
+        before = db.session.query(ReferenceVersion.version).filter_by(name=VERSION_NAME).scalar() or 0
+
+        db.session.add(Stack(name="Cobol"))
+        db.session.commit()
+
+        self.assertIn("Cobol", reference_data.refresh().stack_names.values())
+        self.assertEqual(db.session.query(ReferenceVersion.version).filter_by(name=VERSION_NAME).scalar(), before + 1)
+
+
+    def test_other_process_change(self):
+        """ Does a process reload the data when another process moved the version stamp """
+
+        cache = ReferenceData(check_seconds=0)
+        cache.refresh()
+
+        # A change made by another process: the stamp moves but this process' events don't fire
+        db.session.execute(Stack.__table__.insert().values(name="Fortran"))
+        reference_data.bump(db.session)
+        db.session.commit()
+
+        self.assertIn("Fortran", cache.refresh().stack_names.values())
@@ -1,13 +1,25 @@
 from unittest import TestCase
+import hashlib
+import hmac
+import json
 
+from sqlalchemy import event
 
-from models import db, connect_db, User, Sector, Project, SECTORS
 
+from models import db, connect_db, User, Sector, Project, Job, Stack, ProjectStack, Collaboration, UserPreferenceSector, UserPreferenceStack, UserProjectMatch, SECTORS
+
+import git
 from app import app
+from fake_github import FakeGitHub
+from git import validation_cache
+from jobs import run_pending_jobs
+from reference import reference_data
+from schedule import scheduler
 
 app.config['SQLALCHEMY_DATABASE_URI'] = "postgresql:///colab-test"
 app.config['SQLALCHEMY_ECHO'] = False
 app.config['WTF_CSRF_ENABLED'] = False
+app.config['GITHUB_WEBHOOK_SECRET'] = "webhook-secret"
 
 db.drop_all()
 db.create_all()
@@ -19,15 +31,32 @@ class ViewTestCase(TestCase):
 
     @classmethod
     def setUpClass(cls):
-        "Populate Sector DB"
+        "Populate Sector DB and serve the GitHub API from a local fake"
 
         Sector.add_stacks_to_db()
+
+        # The tests run the job queue themselves
+        scheduler.pause()
+
+        cls.fake = FakeGitHub()
+        cls.fake.add_repo("Kidist-Abraham/Colab", languages={"Python": 60000, "HTML": 20000}, contributors=["Kidist-Abraham"])
+        cls.fake.add_repo("Kidist-Abraham/internAt", languages={"JavaScript": 30000})
+        cls.fake.add_user("Kidist-Abraham", email="kidistabraham@gmail.com")
+        cls.base_url = git.GIT_API_BASE_URL
+        git.GIT_API_BASE_URL = cls.fake.start()
+
+    @classmethod
+    def tearDownClass(cls):
+        git.GIT_API_BASE_URL = cls.base_url
+        cls.fake.stop()
+        scheduler.resume()
         
 
     def setUp(self):
         """Create test client, add sample data."""
 
         self.sector_id = 2
+        Job.query.delete()
         Project.query.delete()
         User.query.delete()
         
@@ -157,6 +186,32 @@ class ViewTestCase(TestCase):
             self.assertIn("You created new project", html)
 
 
+    def test_add_project_syncs_in_background(self):
+        """Does adding a project queue the GitHub sync instead of running it in the request"""
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.testuser.username
+
+            validation_cache.clear()
+            self.fake.requests.clear()
+            resp = c.post(f"/users/{self.testuser.username}/projects/add", data ={"title": "title", "git_repo": "Kidist-Abraham/Colab", "description":"description", "sector": self.sector_id}, follow_redirects= True)
+
+            self.assertIn("being fetched from GitHub", resp.get_data(as_text=True))
+            project = Project.query.filter_by(git_repo="Kidist-Abraham/Colab").one()
+            self.assertEqual(project.sync_status, "syncing")
+            self.assertEqual(project.collaborators, [])
+            self.assertEqual(Job.query.filter_by(key=f"sync_project:{project.id}").count(), 1)
+            # Only the existence of the repository is checked during the request
+            self.assertEqual(len(self.fake.requests), 1)
+
+            # The worker fetches the stacks and collaborators
+            self.assertEqual(run_pending_jobs(), 1)
+            project = Project.query.get(project.id)
+            self.assertEqual(project.sync_status, "synced")
+            self.assertEqual([u.username for u in project.collaborators], [self.testuser.username])
+
+
     def test_show_project(self):
         """Can the '/projects/<project_id>' route show project"""
 
@@ -169,6 +224,41 @@ class ViewTestCase(TestCase):
             self.assertEqual(resp.status_code, 200)
             self.assertIn(self.testproject_["git_repo"], html)
 
+    def test_current_user_is_loaded_once(self):
+        """Is the logged in user loaded from the database once per request"""
+
+        statements = []
+
+        def record(conn, cursor, statement, *args):
+            statements.append(statement)
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.testuser.username
+
+            event.listen(db.engine, "before_cursor_execute", record)
+            try:
+                resp = c.get(f"/projects/{self.testproject_['id']}")
+            finally:
+                event.remove(db.engine, "before_cursor_execute", record)
+
+            self.assertEqual(resp.status_code, 200)
+            # The collaborators of the project are loaded with a join, the user alone
+            self.assertEqual(len([s for s in statements if "FROM users \nWHERE" in s]), 1)
+
+            # The session now carries the user id
+            with c.session_transaction() as sess:
+                self.assertEqual(sess["user_id"], self.testuser.id)
+
+
+    def test_login_required(self):
+        """Are the pages of logged in users redirected to the home page without a session"""
+
+        resp = self.client.get(f"/projects/{self.testproject_['id']}")
+        self.assertEqual(resp.status_code, 302)
+        self.assertEqual(resp.location.rsplit("/", 1)[-1], "")
+
+
     def test_show_projects(self):
         """Can the '/projects' route show all project except the ones owned by the user"""
 
@@ -215,6 +305,278 @@ class ViewTestCase(TestCase):
 
 
 
+    def test_filter_projects_by_stack_share(self):
+        """Does the '/projects' stack filter rank the projects by the share of the stack and apply the minimum share"""
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.testuser.username
+
+            owner = User.register(username="other", email="other@example.com", password="x", first_name="O", last_name="T",
+                                  git_handle="other", is_organisation=False)
+            python = Stack.query.filter_by(name="Python").first() or Stack(name="Python")
+            shell = Stack.query.filter_by(name="Shell").first() or Stack(name="Shell")
+            db.session.add_all([owner, python, shell])
+            db.session.commit()
+            scripts = Project(title="Mostly scripts", git_repo="other/scripts", owned_by="other", sector_id=self.sector_id, primary_stack_id=python.id)
+            tools = Project(title="Some tools", git_repo="other/tools", owned_by="other", sector_id=self.sector_id, primary_stack_id=python.id)
+            db.session.add_all([scripts, tools])
+            db.session.commit()
+            db.session.add_all([ProjectStack(project_id=scripts.id, stack_id=shell.id, share=0.1),
+                                ProjectStack(project_id=scripts.id, stack_id=python.id, share=0.9),
+                                ProjectStack(project_id=tools.id, stack_id=shell.id, share=0.4),
+                                ProjectStack(project_id=tools.id, stack_id=python.id, share=0.6)])
+            db.session.commit()
+
+            html = c.post("/projects", data={"stacks": [shell.id]}).get_data(as_text=True)
+            self.assertLess(html.index("Some tools"), html.index("Mostly scripts"))
+
+            html = c.post("/projects", data={"stacks": [shell.id], "min_share": 20}).get_data(as_text=True)
+            self.assertIn("Some tools", html)
+            self.assertNotIn("Mostly scripts", html)
+
+            html = c.post("/projects", data={"stacks": [shell.id], "primary_stack_only": "y"}).get_data(as_text=True)
+            self.assertNotIn("Some tools", html)
+            self.assertNotIn("Mostly scripts", html)
+
+
+    def test_filter_preferred_projects(self):
+        """Does the '/projects' preferred only filter use the preferences of the user only, and list every project once"""
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.testuser.username
+
+            other = User.register(username="other", email="other@example.com", password="x", first_name="O", last_name="T",
+                                  git_handle="other", is_organisation=False)
+            python = Stack.query.filter_by(name="Python").first() or Stack(name="Python")
+            go = Stack.query.filter_by(name="Go").first() or Stack(name="Go")
+            db.session.add_all([other, python, go])
+            db.session.commit()
+            preferred = Project(title="Preferred project", git_repo="other/preferred", owned_by="other", sector_id=1)
+            liked_by_other = Project(title="Liked by other", git_repo="other/liked", owned_by="other", sector_id=3)
+            db.session.add_all([preferred, liked_by_other])
+            db.session.commit()
+            db.session.add_all([ProjectStack(project_id=preferred.id, stack_id=python.id, share=0.5),
+                                ProjectStack(project_id=preferred.id, stack_id=go.id, share=0.5),
+                                ProjectStack(project_id=liked_by_other.id, stack_id=go.id, share=1),
+                                UserPreferenceStack(username=self.testuser.username, stack_id=python.id),
+                                UserPreferenceSector(username=self.testuser.username, sector_id=1),
+                                UserPreferenceStack(username="other", stack_id=go.id),
+                                UserPreferenceSector(username="other", sector_id=3)])
+            UserProjectMatch.refresh()
+            db.session.commit()
+
+            html = c.post("/projects", data={"show_preferences_only": "y"}).get_data(as_text=True)
+            self.assertEqual(html.count("Preferred project"), 1)
+            self.assertNotIn("Liked by other", html)
+
+            html = c.post("/projects", data={"stacks": [go.id], "show_preferences_only": "y"}).get_data(as_text=True)
+            self.assertEqual(html.count("Preferred project"), 1)
+            self.assertNotIn("Liked by other", html)
+
+
+    def test_preference_matches_are_maintained(self):
+        """Are the preferred projects ranked by score, and rescored when the preferences or a project's sector change"""
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.testuser.username
+
+            other = User.register(username="other", email="other@example.com", password="x", first_name="O", last_name="T",
+                                  git_handle="other", is_organisation=False)
+            python = Stack.query.filter_by(name="Python").first() or Stack(name="Python")
+            db.session.add_all([other, python])
+            db.session.commit()
+            both = Project(title="Stack and sector", git_repo="other/both", owned_by="other", sector_id=1)
+            stack_only = Project(title="Stack only", git_repo="other/stack", owned_by="other", sector_id=3)
+            db.session.add_all([both, stack_only])
+            db.session.commit()
+            db.session.add_all([ProjectStack(project_id=both.id, stack_id=python.id, share=1),
+                                ProjectStack(project_id=stack_only.id, stack_id=python.id, share=1),
+                                UserPreferenceSector(username="other", sector_id=1)])
+            db.session.commit()
+            both_id, stack_only_id, python_id = both.id, stack_only.id, python.id
+
+            c.post("/preferences", data={"stacks": [python_id], "sectors": [1]})
+            scores = dict(db.session.query(UserProjectMatch.project_id, UserProjectMatch.score).filter_by(username="kid"))
+            self.assertEqual(scores, {both_id: 2, stack_only_id: 1})
+            html = c.post("/projects", data={"show_preferences_only": "y"}).get_data(as_text=True)
+            self.assertLess(html.index("Stack and sector"), html.index("Stack only"))
+
+            # Dropping a preference keeps those of the other users
+            c.post("/preferences", data={"sectors": [1]})
+            html = c.post("/projects", data={"show_preferences_only": "y"}).get_data(as_text=True)
+            self.assertIn("Stack and sector", html)
+            self.assertNotIn("Stack only", html)
+            self.assertEqual(UserPreferenceSector.query.filter_by(username="other").count(), 1)
+
+            # Moving a project to a preferred sector makes it match
+            with c.session_transaction() as sess:
+                sess.pop("user_id")
+                sess[CURR_USER_KEY] = "other"
+            c.post(f"/projects/{stack_only_id}/update", data={"title": "Stack only", "git_repo": "other/stack", "sector": 1})
+            self.assertEqual(Project.query.get(stack_only_id).sector_id, 1)
+            self.assertEqual(UserProjectMatch.query.filter_by(username="kid", project_id=stack_only_id).one().score, 1)
+
+
+    def test_search_projects(self):
+        """Does the '/projects' search find the words in titles and descriptions, rank title matches first, and combine with the filters"""
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.testuser.username
+
+            other = User.register(username="other", email="other@example.com", password="x", first_name="O", last_name="T",
+                                  git_handle="other", is_organisation=False)
+            db.session.add(other)
+            db.session.commit()
+            db.session.add_all([Project(title="Weather station", git_repo="other/station", description="Logs sensors", owned_by="other", sector_id=1),
+                                Project(title="Farm tools", git_repo="other/farm", description="Plans crops from weather forecasts", owned_by="other", sector_id=3),
+                                Project(title="Chat", git_repo="other/chat", description="Messages", owned_by="other", sector_id=1)])
+            db.session.commit()
+
+            html = c.post("/projects", data={"search": "weather"}).get_data(as_text=True)
+            self.assertLess(html.index("Weather station"), html.index("Farm tools"))
+            self.assertNotIn("Chat", html)
+
+            # Stemmed, and combined with the sector filter
+            html = c.post("/projects", data={"search": "forecast", "sectors": [3]}).get_data(as_text=True)
+            self.assertIn("Farm tools", html)
+            html = c.post("/projects", data={"search": "forecast", "sectors": [1]}).get_data(as_text=True)
+            self.assertNotIn("Farm tools", html)
+
+            html = c.post("/projects", data={"search": "weather -crops"}).get_data(as_text=True)
+            self.assertIn("Weather station", html)
+            self.assertNotIn("Farm tools", html)
+
+
+    def test_projects_are_paged(self):
+        """Does '/projects' page the projects with a cursor, also across the filter, without repeating or skipping any"""
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.testuser.username
+
+            other = User.register(username="other", email="other@example.com", password="x", first_name="O", last_name="T",
+                                  git_handle="other", is_organisation=False)
+            python = Stack.query.filter_by(name="Python").first() or Stack(name="Python")
+            db.session.add_all([other, python])
+            db.session.commit()
+            projects = [Project(title=f"Paged {i}", git_repo=f"other/paged{i}", owned_by="other", sector_id=self.sector_id) for i in range(7)]
+            db.session.add_all(projects)
+            db.session.commit()
+            # Ties and projects of the sector without the stack
+            for project, share in zip(projects[:5], [0.5, 0.9, 0.5, 0.5, 0.1]):
+                db.session.add(ProjectStack(project_id=project.id, stack_id=python.id, share=share))
+            db.session.commit()
+            python_id = python.id
+
+            def titles(html):
+                return [line.split(">")[1].split("<")[0] for line in html.splitlines() if 'class="card-title">Paged' in line]
+
+            app.config['PROJECTS_PAGE_SIZE'] = 3
+            try:
+                seen = []
+                after = None
+                while True:
+                    resp = c.get("/projects", query_string={"after": after} if after else {})
+                    seen.extend(titles(resp.get_data(as_text=True)))
+                    cursor = [line for line in resp.get_data(as_text=True).splitlines() if "?after=" in line]
+                    if not cursor:
+                        break
+                    after = cursor[0].split("?after=")[1].split('"')[0]
+                self.assertEqual(seen, [f"Paged {i}" for i in range(7)])
+
+                seen = []
+                data = {"stacks": [python_id], "sectors": [self.sector_id]}
+                while True:
+                    html = c.post("/projects", data=data).get_data(as_text=True)
+                    seen.extend(titles(html))
+                    cursor = [line for line in html.splitlines() if 'name="after"' in line]
+                    if not cursor:
+                        break
+                    data["after"] = cursor[0].split('value="')[1].split('"')[0]
+                self.assertEqual(seen, [f"Paged {i}" for i in [1, 0, 2, 3, 4, 5, 6]])
+
+                # The search ranks are all equal, so the cursor has to round-trip them exactly
+                seen = []
+                data = {"search": "paged"}
+                while True:
+                    html = c.post("/projects", data=data).get_data(as_text=True)
+                    seen.extend(titles(html))
+                    cursor = [line for line in html.splitlines() if 'name="after"' in line]
+                    if not cursor:
+                        break
+                    data["after"] = cursor[0].split('value="')[1].split('"')[0]
+                self.assertEqual(seen, [f"Paged {i}" for i in range(7)])
+            finally:
+                app.config['PROJECTS_PAGE_SIZE'] = 20
+
+
+    def count_queries(self, client, url, method="get", **kwargs):
+        statements = []
+
+        def record(conn, cursor, statement, *args):
+            statements.append(statement)
+
+        event.listen(db.engine, "before_cursor_execute", record)
+        try:
+            resp = getattr(client, method)(url, **kwargs)
+        finally:
+            event.remove(db.engine, "before_cursor_execute", record)
+        self.assertEqual(resp.status_code, 200)
+        return len(statements)
+
+
+    def test_query_count_is_bounded(self):
+        """Does the number of queries of the project pages stay the same whatever the number of projects, stacks and collaborators"""
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.testuser.username
+
+            other = User.register(username="other", email="other@example.com", password="x", first_name="O", last_name="T",
+                                  git_handle="other", is_organisation=False)
+            stacks = [Stack.query.filter_by(name=name).first() or Stack(name=name) for name in ["Python", "Go", "C"]]
+            db.session.add_all([other] + stacks)
+            db.session.commit()
+            stack_ids = [stack.id for stack in stacks]
+            sector_ids = [sector.id for sector in Sector.query.all()]
+
+            def add_projects(count, start):
+                projects = [Project(title=f"Counted {i}", git_repo=f"other/counted{i}", owned_by=owner, sector_id=sector_ids[i % len(sector_ids)])
+                            for i in range(start, start + count) for owner in ["other", self.testuser.username]]
+                db.session.add_all(projects)
+                db.session.commit()
+                for project in projects:
+                    db.session.add_all([ProjectStack(project_id=project.id, stack_id=stack_id, share=0.3) for stack_id in stack_ids])
+                    db.session.add_all([Collaboration(project_id=project.id, username=username) for username in ["other", self.testuser.username]])
+                db.session.commit()
+                return projects[0].id
+
+            def counts(project_id):
+                c.get("/projects")
+                return [self.count_queries(c, "/projects"),
+                        self.count_queries(c, "/projects", method="post", data={"stacks": stack_ids}),
+                        self.count_queries(c, "/owned-projects"),
+                        self.count_queries(c, f"/users/{self.testuser.username}"),
+                        self.count_queries(c, f"/users/other"),
+                        self.count_queries(c, f"/projects/{project_id}")]
+
+            # The reference data is loaded once and not checked again during the test
+            check_seconds, reference_data.check_seconds = reference_data.check_seconds, 3600
+            try:
+                reference_data.invalidate()
+                few = counts(add_projects(2, 0))
+                many = counts(add_projects(10, 2))
+            finally:
+                reference_data.check_seconds = check_seconds
+
+            self.assertEqual(few, many)
+            self.assertLessEqual(max(many), 6)
+
+
     def test_show_owned_projects(self):
         """Can the '/owned-projects'route show all project owned by the logged in user and not other users"""
 
@@ -292,4 +654,81 @@ class ViewTestCase(TestCase):
             self.assertEqual(resp.status_code, 200)
             self.assertIn("Hero", html)
 
-   
\ No newline at end of file
+
+    def test_github_status(self):
+        """Does the '/status/github' route show the state of the GitHub rate limit governor"""
+
+        with self.client as c:
+            resp = c.get("/status/github")
+
+            self.assertEqual(resp.status_code, 200)
+            self.assertIn("buckets", resp.json)
+            self.assertIn("rejected", resp.json)
+
+
+    def test_metrics(self):
+        """Does the '/metrics' route expose the request and GitHub call metrics"""
+
+        with self.client as c:
+            c.get("/status/github")
+            resp = c.get("/metrics")
+            body = resp.get_data(as_text=True)
+
+            self.assertEqual(resp.status_code, 200)
+            self.assertIn('colab_http_request_duration_seconds_count{endpoint="github_status",method="GET",status="200"}', body)
+            self.assertIn("colab_github_requests_total", body)
+
+
+    def post_webhook(self, event, payload, secret="webhook-secret"):
+        body = json.dumps(payload).encode()
+        signature = "sha256=" + hmac.new(secret.encode(), body, hashlib.sha256).hexdigest()
+        return self.client.post("/webhooks/github", data=body, content_type="application/json",
+                                headers={"X-GitHub-Event": event, "X-Hub-Signature-256": signature})
+
+
+    def test_github_webhook_signature(self):
+        """Does the '/webhooks/github' route reject events that are not signed with the webhook secret"""
+
+        resp = self.post_webhook("push", {"repository": {"full_name": "Kidist-Abraham/internAt"}}, secret="wrong")
+        self.assertEqual(resp.status_code, 403)
+
+
+    def test_github_webhook_push(self):
+        """Does a push event queue a refresh of the projects of the repository"""
+
+        resp = self.post_webhook("push", {"repository": {"full_name": "kidist-abraham/InternAt"}})
+
+        self.assertEqual(resp.status_code, 202)
+        self.assertEqual(resp.json["projects"], [self.testproject_["id"]])
+
+
+    def test_github_webhook_rename(self):
+        """Does a repository renamed event move the projects to the new repository name"""
+
+        payload = {"action": "renamed",
+                   "repository": {"full_name": "Kidist-Abraham/internAt2", "owner": {"login": "Kidist-Abraham"}},
+                   "changes": {"repository": {"name": {"from": "internAt"}}}}
+        resp = self.post_webhook("repository", payload)
+
+        self.assertEqual(resp.status_code, 202)
+        self.assertEqual(Project.query.get(self.testproject_["id"]).git_repo, "Kidist-Abraham/internAt2")
+
+
+    def test_edit_project_keeps_repo(self):
+        """Does editing a project without changing its repository skip the GitHub check"""
+
+        validation_cache.clear()
+        self.fake.requests.clear()
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.testuser.username
+
+            resp = c.post(f"/projects/{self.testproject_['id']}/update",
+                          data={"title": "New title", "git_repo": self.testproject_["git_repo"], "description": "d", "sector": self.sector_id},
+                          follow_redirects=True)
+
+            self.assertEqual(resp.status_code, 200)
+            self.assertIn("New title", resp.get_data(as_text=True))
+            self.assertEqual(self.fake.requests, [])
+
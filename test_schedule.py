@@ -0,0 +1,257 @@
+from unittest import TestCase
+import threading
+import time
+from datetime import datetime, timedelta
+from sqlalchemy import func, select
+
+from app import app
+from models import db, User, Project, Collaboration, Sector, Stack, ProjectStack, ProjectContributor, UserPreferenceStack, UserProjectMatch
+from schedule import leader_job, advisory_lock_key, fetch_for_repos, record_sync, sync_collaborators, sync_stacks, stack_index, MIN_SYNC_INTERVAL, MAX_SYNC_INTERVAL
+
+app.config['SQLALCHEMY_DATABASE_URI'] = "postgresql:///colab-test"
+app.config['SQLALCHEMY_ECHO'] = False
+
+db.create_all()
+
+
+class FetchForReposTestCase(TestCase):
+    """Test the concurrent fetch stage of the scheduler jobs."""
+
+
+    def test_shared_repos_are_fetched_once(self):
+        """ Does fetch_for_repos call the fetcher once per distinct repo """
+
+        calls = []
+        result = fetch_for_repos(lambda repo: calls.append(repo) or repo.upper(), ["a/x", "b/y", "a/x"])
+
+        self.assertEqual(result, {"a/x": "A/X", "b/y": "B/Y"})
+        self.assertEqual(sorted(calls), ["a/x", "b/y"])
+
+
+    def test_concurrency_is_bounded(self):
+        """ Does fetch_for_repos never run more fetches at once than the concurrency limit """
+
+        lock = threading.Lock()
+        running = []
+        peak = []
+
+        def fetch(repo):
+            with lock:
+                running.append(repo)
+                peak.append(len(running))
+            time.sleep(0.01)
+            with lock:
+                running.remove(repo)
+            return True
+
+        fetch_for_repos(fetch, [f"owner/repo{i}" for i in range(20)], concurrency=3)
+
+        self.assertEqual(max(peak), 3)
+
+
+class RecordSyncTestCase(TestCase):
+    """Test the scheduling of the next refresh of a project."""
+
+    def setUp(self):
+        self.now = datetime(2022, 8, 10)
+        self.project = Project(git_repo="a/b", sync_failures=0, next_sync_at=self.now)
+
+
+    def test_first_sync(self):
+        """ Is a project refreshed for the first time due again after the minimum interval """
+
+        self.assertTrue(record_sync(self.project, {"pushed_at": "2022-08-01T00:00:00Z"}, self.now))
+
+        self.assertEqual(self.project.pushed_at, datetime(2022, 8, 1))
+        self.assertEqual(self.project.last_synced_at, self.now)
+        self.assertEqual(self.project.next_sync_at, self.now + MIN_SYNC_INTERVAL)
+
+
+    def test_dormant_repo_backs_off(self):
+        """ Does the interval double on every refresh that finds no new push, up to the maximum """
+
+        meta = {"pushed_at": "2022-08-01T00:00:00Z"}
+        now = self.now
+        intervals = []
+        for _ in range(12):
+            record_sync(self.project, meta, now)
+            intervals.append(self.project.next_sync_at - now)
+            now = self.project.next_sync_at
+
+        self.assertEqual(intervals[:4], [MIN_SYNC_INTERVAL * k for k in (1, 2, 4, 8)])
+        self.assertEqual(intervals[-1], MAX_SYNC_INTERVAL)
+
+        # A new push brings the project back to the minimum interval
+        record_sync(self.project, {"pushed_at": "2022-09-01T00:00:00Z"}, now)
+        self.assertEqual(self.project.next_sync_at - now, MIN_SYNC_INTERVAL)
+
+
+    def test_failures_back_off(self):
+        """ Are failing refreshes counted and retried less and less often """
+
+        self.assertFalse(record_sync(self.project, None, self.now))
+        self.assertFalse(record_sync(self.project, {"pushed_at": None, "collaborators": False}, self.now))
+
+        self.assertEqual(self.project.sync_failures, 2)
+        self.assertEqual(self.project.next_sync_at, self.now + MIN_SYNC_INTERVAL * 4)
+        self.assertIsNone(self.project.last_synced_at)
+
+        record_sync(self.project, {"pushed_at": None}, self.now)
+        self.assertEqual(self.project.sync_failures, 0)
+        self.assertEqual(self.project.next_sync_at, self.now + MIN_SYNC_INTERVAL)
+
+
+class SyncCollaboratorsTestCase(TestCase):
+    """Test the collaborator diff of the scheduler jobs."""
+
+    def setUp(self):
+        Project.query.delete()
+        User.query.delete()
+        db.session.commit()
+        sector = Sector.query.first() or Sector(name="Other")
+        db.session.add_all([sector] + [User(username=f"user{i}", email=f"user{i}@example.com", first_name="User",
+                                            last_name=str(i), git_handle=f"handle{i}", password="x") for i in range(4)])
+        db.session.commit()
+        self.p1 = Project(title="One", git_repo="owner/one", owned_by="user0", sector_id=sector.id)
+        self.p2 = Project(title="Two", git_repo="owner/two", owned_by="user0", sector_id=sector.id)
+        db.session.add_all([self.p1, self.p2])
+        db.session.commit()
+        db.session.add_all([Collaboration(project_id=self.p1.id, username="user1"),
+                            Collaboration(project_id=self.p1.id, username="user2"),
+                            Collaboration(project_id=self.p2.id, username="user1")])
+        db.session.commit()
+
+    def tearDown(self):
+        db.session.rollback()
+
+
+    def collaborators(self, project):
+        return sorted(u for (u,) in db.session.query(Collaboration.username).filter_by(project_id=project.id))
+
+
+    def test_collaborators_are_diffed(self):
+        """ Are new contributors that are users linked and the ones that left unlinked, only on their own project """
+
+        sync_collaborators([self.p1, self.p2], {
+            "owner/one": {"collaborators": ["handle2", "handle3", "stranger"]},
+            "owner/two": {"collaborators": ["handle1", "handle2"]},
+        })
+
+        self.assertEqual(self.collaborators(self.p1), ["user2", "user3"])
+        self.assertEqual(self.collaborators(self.p2), ["user1", "user2"])
+        self.assertEqual(sorted(login for (login,) in db.session.query(ProjectContributor.login).filter_by(project_id=self.p1.id)),
+                         ["handle2", "handle3", "stranger"])
+
+
+    def test_new_users_are_backfilled(self):
+        """ Is a user who registers after their repositories were synced linked to them without a refresh """
+
+        sync_collaborators([self.p1, self.p2], {
+            "owner/one": {"collaborators": ["handle1", "newcomer"]},
+            "owner/two": {"collaborators": ["newcomer"]},
+        })
+        user = User(username="newcomer", email="newcomer@example.com", first_name="New", last_name="Comer",
+                    git_handle="newcomer", password="x")
+        db.session.add(user)
+        db.session.flush()
+        user.backfill_collaborations()
+        db.session.commit()
+
+        self.assertEqual(self.collaborators(self.p1), ["newcomer", "user1"])
+        self.assertEqual(self.collaborators(self.p2), ["newcomer"])
+
+
+    def test_failed_fetches_are_skipped(self):
+        """ Are the collaborators of a project kept when its contributors couldn't be fetched """
+
+        sync_collaborators([self.p1, self.p2], {
+            "owner/one": {"collaborators": False},
+            "owner/two": None,
+        })
+
+        self.assertEqual(self.collaborators(self.p1), ["user1", "user2"])
+        self.assertEqual(self.collaborators(self.p2), ["user1"])
+
+
+class SyncStacksTestCase(TestCase):
+    """Test the stack sync of the scheduler jobs."""
+
+    def setUp(self):
+        Project.query.delete()
+        User.query.delete()
+        Stack.query.filter(Stack.name.in_(["Python", "Zig"])).delete(synchronize_session=False)
+        db.session.commit()
+        sector = Sector.query.first() or Sector(name="Other")
+        db.session.add_all([sector, Stack(name="Python"),
+                            User(username="user0", email="user0@example.com", first_name="User", last_name="0", git_handle="handle0", password="x")])
+        db.session.commit()
+        self.project = Project(title="One", git_repo="owner/one", owned_by="user0", sector_id=sector.id)
+        db.session.add(self.project)
+        db.session.commit()
+        stack_index.load()
+
+    def tearDown(self):
+        db.session.rollback()
+
+
+    def test_stacks_are_linked_once(self):
+        """ Are unknown languages registered as stacks, and are languages already linked not linked again """
+
+        metadata = {"owner/one": {"languages": {"Python": 300, "Zig": 100}}}
+        sync_stacks([self.project], metadata)
+        db.session.commit()
+        sync_stacks([self.project], metadata)
+        db.session.commit()
+
+        project = Project.query.get(self.project.id)
+        self.assertEqual(sorted(stack.name for stack in project.stacks), ["Python", "Zig"])
+        self.assertEqual(ProjectStack.query.filter_by(project_id=self.project.id).count(), 2)
+        self.assertEqual(project.primary_stack.name, "Python")
+        self.assertEqual(stack_index.ids["Zig"], Stack.query.filter_by(name="Zig").one().id)
+
+        # The shares and the primary stack follow the repository
+        sync_stacks([self.project], {"owner/one": {"languages": {"Zig": 300}}})
+        db.session.commit()
+        project = Project.query.get(self.project.id)
+        self.assertEqual({link.stack_id: link.share for link in ProjectStack.query.filter_by(project_id=project.id)},
+                         {stack_index.ids["Python"]: 0, stack_index.ids["Zig"]: 1})
+        self.assertEqual(project.primary_stack.name, "Zig")
+
+
+    def test_new_stacks_rescore_the_project(self):
+        """ Does linking a stack to a project make it match the users who prefer the stack """
+
+        db.session.add(User(username="user1", email="user1@example.com", first_name="User", last_name="1", git_handle="handle1", password="x"))
+        db.session.flush()
+        db.session.add(UserPreferenceStack(username="user1", stack_id=stack_index.ids["Python"]))
+        db.session.commit()
+
+        sync_stacks([self.project], {"owner/one": {"languages": {"Python": 300}}})
+        db.session.commit()
+
+        self.assertEqual([(m.username, m.score) for m in UserProjectMatch.query.filter_by(project_id=self.project.id)], [("user1", 1)])
+
+
+class LeaderJobTestCase(TestCase):
+    """Test the leader election of the scheduled jobs."""
+
+
+    def test_job_runs_only_without_leader(self):
+        """ Is a job skipped while another process holds its lock, and run once the lock is released """
+
+        runs = []
+
+        @leader_job
+        def job():
+            runs.append(1)
+            return "ran"
+
+        key = advisory_lock_key("job")
+        with db.engine.connect() as other:
+            other.execute(select(func.pg_advisory_lock(key)))
+            self.assertIsNone(job())
+            other.execute(select(func.pg_advisory_unlock(key)))
+
+        self.assertEqual(job(), "ran")
+        self.assertEqual(runs, [1])
+
@@ -0,0 +1,110 @@
+from unittest import TestCase
+
+from sqlalchemy import text
+
+from app import app
+from models import (db, User, Project, Collaboration, Sector, Stack, ProjectStack, ProjectContributor, SchemaMigration,
+                    UserPreferenceStack)
+from migrations import migrate, MIGRATIONS
+from explain_queries import check, full_scans
+
+app.config['SQLALCHEMY_DATABASE_URI'] = "postgresql:///colab-test"
+app.config['SQLALCHEMY_ECHO'] = False
+
+db.create_all()
+
+
+def seed():
+    Project.query.delete()
+    User.query.delete()
+    Stack.query.filter_by(name="Zig").delete()
+    db.session.commit()
+
+    user = User(username="migrator", email="migrator@example.com", first_name="Mig", last_name="Rator",
+                git_handle="migrator", password="x")
+    other = User(username="other", email="other@example.com", first_name="Ot", last_name="Her", git_handle="other", password="x")
+    sector = Sector.query.first() or Sector(name="Other")
+    stack = Stack(name="Zig")
+    db.session.add_all([user, other, sector, stack])
+    db.session.flush()
+    project = Project(title="Schema", git_repo="migrator/schema", owned_by="migrator", sector_id=sector.id)
+    db.session.add(project)
+    db.session.flush()
+    db.session.add_all([ProjectStack(project_id=project.id, stack_id=stack.id, share=1.0),
+                        Collaboration(project_id=project.id, username="other"),
+                        ProjectContributor(project_id=project.id, login="other"),
+                        UserPreferenceStack(username="migrator", stack_id=stack.id)])
+    db.session.commit()
+    return user, project
+
+
+class MigrateTestCase(TestCase):
+    """Test the versioned schema migrations."""
+
+    def setUp(self):
+        self.user, self.project = seed()
+
+    def tearDown(self):
+        db.session.rollback()
+
+
+    def test_migrations_are_applied_once(self):
+        """ Does migrate record every migration and apply none of them again """
+
+        migrate()
+
+        self.assertEqual([m.version for m in SchemaMigration.query.order_by(SchemaMigration.version)],
+                         [version for version, _, _ in MIGRATIONS])
+        self.assertEqual(migrate(), [])
+
+
+    def test_duplicate_links_are_removed(self):
+        """ Does the unique links migration keep the latest of the duplicate rows of a database made before it """
+
+        migrate()
+        db.session.execute(text("ALTER TABLE collaborations DROP CONSTRAINT uq_collaborations_project_id_username"))
+        db.session.execute(text("ALTER TABLE project_stacks DROP CONSTRAINT uq_project_stacks_project_id_stack_id"))
+        db.session.add_all([Collaboration(project_id=self.project.id, username="other"),
+                            ProjectStack(project_id=self.project.id, stack_id=self.project.stacks[0].id, share=0.5)])
+        SchemaMigration.query.filter_by(version=2).delete()
+        db.session.commit()
+
+        self.assertEqual(migrate(), [2])
+
+        self.assertEqual(Collaboration.query.filter_by(project_id=self.project.id).count(), 1)
+        self.assertEqual([link.share for link in ProjectStack.query.filter_by(project_id=self.project.id)], [0.5])
+        db.session.add(Collaboration(project_id=self.project.id, username="other"))
+        with self.assertRaises(Exception):
+            db.session.commit()
+
+
+class ExplainQueriesTestCase(TestCase):
+    """Test the EXPLAIN check of the key queries."""
+
+    def setUp(self):
+        self.user, self.project = seed()
+        db.session.execute(text("ANALYZE"))
+        db.session.commit()
+
+    def tearDown(self):
+        db.session.rollback()
+
+
+    def test_full_scans(self):
+        """ Does full_scans find sequential scans and index scans that filter most rows without an index condition """
+
+        sizes = {"projects": 1000}
+        plan = {"Node Type": "Nested Loop", "Plans": [
+            {"Node Type": "Seq Scan", "Relation Name": "stacks"},
+            {"Node Type": "Index Scan", "Relation Name": "projects", "Filter": "(owned_by = 'a')", "Plan Rows": 5},
+            {"Node Type": "Index Scan", "Relation Name": "projects", "Index Cond": "(id = 1)", "Plan Rows": 1}]}
+
+        self.assertEqual(full_scans(plan, sizes), {"stacks", "projects"})
+        plan["Plans"][1]["Plan Rows"] = 999
+        self.assertEqual(full_scans(plan, sizes), {"stacks"})
+
+
+    def test_key_queries_have_indexes(self):
+        """ Does every key query find an index for the large tables it reads when sequential scans are discouraged """
+
+        self.assertEqual(check(self.user, seqscan=False), [])